@@ -1,15 +1,33 @@
 import os
 import re
+import sys
+import time
 import asyncio
 import json
+import io
 import uuid
+import hashlib
+import shutil
+import tempfile
+import zipfile
+import zlib
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from contextlib import asynccontextmanager
+import sqlite3
+from urllib.parse import quote, urlencode, urljoin
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import pdfplumber
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
-from typing import Dict, List, Tuple, Optional, Set
+from typing import (
+    Dict, List, Tuple, Optional, Set, Callable, Awaitable, Union,
+    Iterable, Iterator, AsyncIterator, AsyncContextManager
+)
 import aiohttp
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
 from aiogram.filters import Command
 from aiogram.types import (
     ReplyKeyboardMarkup, KeyboardButton,
@@ -18,27 +36,462 @@ from aiogram.types import (
 )
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
 from aiogram.fsm.storage.memory import MemoryStorage
 from sklearn.cluster import KMeans
+from scipy.optimize import linear_sum_assignment
 from geopy.geocoders import Nominatim
 from aiohttp import web
 
 # Загрузка конфигурации
 TOKEN = os.getenv("BOT_TOKEN")
 TOMTOM_API_KEY = os.getenv("TOMTOM_API_KEY")
+TOMTOM_BASE_URL = os.getenv("TOMTOM_BASE_URL", "https://api.tomtom.com").rstrip("/")
 PRODUCTION_ADDRESS = os.getenv("PRODUCTION_ADDRESS", "Москва, ул. Лавочкина, 34")
+DATA_DIR = os.getenv("DATA_DIR", "data")
+GEOCODE_CACHE_TTL = int(os.getenv("GEOCODE_CACHE_TTL_DAYS", 90)) * 86400
+GEOCODE_NEGATIVE_TTL = int(os.getenv("GEOCODE_NEGATIVE_TTL_HOURS", 6)) * 3600
+GEOCODE_CONCURRENCY = int(os.getenv("GEOCODE_CONCURRENCY", 8))
+TOMTOM_RPS = float(os.getenv("TOMTOM_RPS", 5))
+NOMINATIM_RPS = float(os.getenv("NOMINATIM_RPS", 1))
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", 100))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", 20))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 30))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", 300))
+GEOCODE_MODE = os.getenv("GEOCODE_MODE", "single")  # single | batch
+TOMTOM_BATCH_SYNC_LIMIT = int(os.getenv("TOMTOM_BATCH_SYNC_LIMIT", 100))
+TOMTOM_BATCH_MAX_ITEMS = int(os.getenv("TOMTOM_BATCH_MAX_ITEMS", 10000))
+TOMTOM_BATCH_TIMEOUT = int(os.getenv("TOMTOM_BATCH_TIMEOUT", 300))
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", os.cpu_count() or 2))
+PDF_PARSE_TIMEOUT = float(os.getenv("PDF_PARSE_TIMEOUT", 60))
+PDF_MAX_SIZE = int(float(os.getenv("PDF_MAX_SIZE_MB", 20)) * 1024 * 1024)
+PDF_MEMORY_LIMIT = int(float(os.getenv("PDF_MEMORY_LIMIT_MB", 10)) * 1024 * 1024)
+ZIP_MAX_FILES = int(os.getenv("ZIP_MAX_FILES", 200))
+ALBUM_COLLECT_DELAY = float(os.getenv("ALBUM_COLLECT_DELAY", 1.5))
+DISTANCE_MATRIX_MAX_POINTS = int(os.getenv("DISTANCE_MATRIX_MAX_POINTS", 3000))
+ROUTE_SOLVER_TIME_BUDGET = float(os.getenv("ROUTE_SOLVER_TIME_BUDGET", 0.3))
+ROUTING_MATRIX_MODE = os.getenv("ROUTING_MATRIX_MODE", "haversine")  # haversine | tomtom
+TOMTOM_MATRIX_MAX_CELLS = int(os.getenv("TOMTOM_MATRIX_MAX_CELLS", 200))  # лимит синхронного Matrix v2 на запрос
+TOMTOM_MATRIX_MAX_POINTS = int(os.getenv("TOMTOM_MATRIX_MAX_POINTS", 150))
+TOMTOM_MATRIX_CONCURRENCY = int(os.getenv("TOMTOM_MATRIX_CONCURRENCY", 4))
+TRAVEL_MATRIX_BUCKET_MINUTES = int(os.getenv("TRAVEL_MATRIX_BUCKET_MINUTES", 60))
+TRAVEL_MATRIX_CACHE_TTL = int(os.getenv("TRAVEL_MATRIX_CACHE_TTL_DAYS", 30)) * 86400
+ROAD_CIRCUITY = float(os.getenv("ROAD_CIRCUITY", 1.3))
+AVERAGE_SPEED_KMH = float(os.getenv("AVERAGE_SPEED_KMH", 25))
+MAX_DRIVERS = int(os.getenv("MAX_DRIVERS", 50))
+CLUSTER_EXACT_MAX_POINTS = int(os.getenv("CLUSTER_EXACT_MAX_POINTS", 600))
+CLUSTER_MAX_ITER = int(os.getenv("CLUSTER_MAX_ITER", 10))
+BALANCE_MODE = os.getenv("BALANCE_MODE", "count")  # count | duration
+SERVICE_TIME_MINUTES = float(os.getenv("SERVICE_TIME_MINUTES", 10))
+BALANCE_TIME_BUDGET = float(os.getenv("BALANCE_TIME_BUDGET", 1.0))
+DURATION_BALANCE_TOLERANCE = float(os.getenv("DURATION_BALANCE_TOLERANCE", 0.15))
+DISTRIBUTION_ENGINE = os.getenv("DISTRIBUTION_ENGINE", "cluster")  # cluster | savings
+ROUTE_MAX_STOPS = int(os.getenv("ROUTE_MAX_STOPS", 0))  # 0 - без ограничения
+ROUTE_MAX_DURATION_MINUTES = float(os.getenv("ROUTE_MAX_DURATION_MINUTES", 0))  # 0 - без ограничения
+SAVINGS_NEIGHBORS = int(os.getenv("SAVINGS_NEIGHBORS", 40))
+ROUTE_CONCURRENCY = int(os.getenv("ROUTE_CONCURRENCY", 4))
+ROUTE_TIMEOUT = int(os.getenv("ROUTE_TIMEOUT", 30))
+ROUTE_CACHE_BUCKET_MINUTES = int(os.getenv("ROUTE_CACHE_BUCKET_MINUTES", 15))
+ROUTE_CACHE_MAX_MB = float(os.getenv("ROUTE_CACHE_MAX_MB", 64))
+# Средняя скорость грузовика по Москве (км/ч) для каждого часа суток, с 00:00 до 23:00
+SPEED_PROFILE_KMH = [float(v) for v in os.getenv(
+    "SPEED_PROFILE_KMH",
+    "38,40,40,40,38,34,28,20,17,18,22,24,24,24,23,22,20,17,16,18,23,28,32,35"
+).split(",")]
+ROUTE_WAIT_SECONDS = float(os.getenv("ROUTE_WAIT_SECONDS", 10))
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "sqlite")  # sqlite | redis | memory
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", os.path.join(DATA_DIR, "sessions.db"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+SESSION_MAX_LIVE = int(os.getenv("SESSION_MAX_LIVE", 200))
+SESSION_IDLE_TTL = int(os.getenv("SESSION_IDLE_TTL", 3600))
+SESSION_SWEEP_INTERVAL = int(os.getenv("SESSION_SWEEP_INTERVAL", 60))
+EDIT_MODE = os.getenv("EDIT_MODE", "queue")  # queue | instant
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x}
+
+# --- Хранилище сессий ---
+# Сессии и состояния FSM переживают перезапуск: они хранятся как хэши
+# (поле -> сжатый JSON) в SQLite или Redis. Интерфейс SQLiteHashStore повторяет
+# подмножество redis-py: hset / hget / hgetall / hdel / delete / scan_iter.
+class SQLiteHashStore:
+    """Хэши в стиле Redis поверх SQLite"""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "name TEXT, field TEXT, value BLOB, updated_at REAL, PRIMARY KEY (name, field))"
+        )
+        self.conn.commit()
+
+    def hset(self, name: str, key: Optional[str] = None, value=None, mapping: Optional[Dict] = None) -> int:
+        items = dict(mapping or {})
+        if key is not None:
+            items[key] = value
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO hashes (name, field, value, updated_at) VALUES (?, ?, ?, ?)",
+            [(name, field, data.encode("utf-8") if isinstance(data, str) else data, now)
+             for field, data in items.items()]
+        )
+        self.conn.commit()
+        return len(items)
+
+    def hget(self, name: str, key: str) -> Optional[bytes]:
+        row = self.conn.execute("SELECT value FROM hashes WHERE name = ? AND field = ?", (name, key)).fetchone()
+        return row[0] if row else None
+
+    def hgetall(self, name: str) -> Dict[bytes, bytes]:
+        rows = self.conn.execute("SELECT field, value FROM hashes WHERE name = ?", (name,)).fetchall()
+        return {field.encode("utf-8"): value for field, value in rows}
+
+    def hdel(self, name: str, *keys: str) -> int:
+        if not keys:
+            return 0
+        placeholders = ",".join("?" * len(keys))
+        cursor = self.conn.execute(f"DELETE FROM hashes WHERE name = ? AND field IN ({placeholders})", (name, *keys))
+        self.conn.commit()
+        return cursor.rowcount
+
+    def delete(self, *names: str) -> int:
+        if not names:
+            return 0
+        placeholders = ",".join("?" * len(names))
+        cursor = self.conn.execute(f"DELETE FROM hashes WHERE name IN ({placeholders})", names)
+        self.conn.commit()
+        return cursor.rowcount
+
+    def scan_iter(self, match: str = "*") -> Iterator[bytes]:
+        pattern = match.replace("%", r"\%").replace("_", r"\_").replace("*", "%")
+        rows = self.conn.execute(
+            "SELECT DISTINCT name FROM hashes WHERE name LIKE ? ESCAPE '\\'", (pattern,)
+        ).fetchall()
+        for (name,) in rows:
+            yield name.encode("utf-8")
+
+    def close(self):
+        self.conn.close()
+
+def create_session_backend():
+    """Хранилище хэшей по SESSION_BACKEND: SQLite по умолчанию или Redis"""
+    if SESSION_BACKEND == "redis":
+        import redis  # необязательная зависимость, нужна только для SESSION_BACKEND=redis
+        return redis.Redis.from_url(REDIS_URL)
+    return SQLiteHashStore(SESSION_DB_PATH)
+
+def _text(value: Union[bytes, str]) -> str:
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+def _json_default(value):
+    # Линия маршрута хранится в отдельном поле хэша, в основной записи только сводка
+    if isinstance(value, RouteRecord):
+        return value.to_dict(with_polyline=False)
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} не сериализуется")
+
+def pack_value(value) -> bytes:
+    """Компактная сериализация: JSON без пробелов, сжатый zlib"""
+    return zlib.compress(
+        json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=_json_default).encode("utf-8"), 6
+    )
+
+def unpack_value(blob: bytes):
+    return json.loads(zlib.decompress(blob))
+
+class SessionStore(MutableMapping):
+    """Сессии пользователей: словарь в памяти с записью в хранилище после изменений
+    
+    Сессия хранится в хэше session:<user_id>: поле core - все, включая сводки
+    маршрутов, поля route:<driver_id> - закодированные линии маршрутов (читаются
+    лениво). Матрица расстояний не сохраняется и при необходимости строится заново.
+    
+    В памяти держится не больше SESSION_MAX_LIVE сессий; давно не использованные и
+    простаивающие дольше SESSION_IDLE_TTL вытесняются. Вытесненная сессия сначала
+    записывается и при следующем обращении читается снова. Без хранилища
+    (backend=None) сессии не вытесняются: данные пропали бы, а состояние FSM в
+    MemoryStorage осталось бы, и пользователь посреди сценария получил бы ошибку.
+    """
+
+    TRANSIENT_FIELDS = ('distance_matrix',)
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.sessions: "OrderedDict[int, Dict]" = OrderedDict()  # от давно использованных к недавним
+        self.last_access: Dict[int, float] = {}
+        self.pinned: Dict[int, int] = {}  # сессии с апдейтами в обработке не вытесняются
+        self.evictions = 0
+        self.touched: Set[int] = set()
+        self.saved_core: Dict[int, bytes] = {}
+        # Уже записанные RouteRecord по маршрутам: неизмененные не переписываются
+        self.saved_routes: Dict[int, Dict[int, object]] = {}
+
+    @staticmethod
+    def _name(user_id: int) -> str:
+        return f"session:{user_id}"
+
+    def _load(self, user_id: int) -> Optional[Dict]:
+        if self.backend is None:
+            return None
+        blob = self.backend.hget(self._name(user_id), "core")
+        if blob is None:
+            return None
+        session = unpack_value(blob)
+        
+        # JSON превращает ключи-числа в строки, а кортежи в списки
+        if session.get('production_coords'):
+            session['production_coords'] = tuple(session['production_coords'])
+        session['address_coords'] = {addr: tuple(c) for addr, c in (session.get('address_coords') or {}).items()}
+        session['return_to_base'] = {int(k): v for k, v in (session.get('return_to_base') or {}).items()}
+        
+        saved = self.saved_routes[user_id] = {}
+        if session.get('routes_info'):
+            routes_info = {}
+            for key, info in session['routes_info'].items():
+                driver_id = int(key)
+                info['waypoints'] = [tuple(point) for point in info.get('waypoints', [])]
+                # Фоновый пересчет не переживает перезапуск: без ответа TomTom маршрут показывается по оценке
+                if info.get('route_status') == "pending":
+                    info['route_status'] = None
+                if info.get('route'):
+                    info['route'] = RouteRecord.from_dict(
+                        info['route'], lambda field=f"route:{driver_id}": self._load_route(user_id, field)
+                    )
+                saved[driver_id] = info.get('route')
+                routes_info[driver_id] = info
+            session['routes_info'] = routes_info
+        
+        self.sessions[user_id] = session
+        self.last_access[user_id] = time.monotonic()
+        self.saved_core[user_id] = hashlib.sha1(blob).digest()
+        return session
+
+    def _load_route(self, user_id: int, field: str) -> Optional[str]:
+        blob = self.backend.hget(self._name(user_id), field)
+        return unpack_value(blob) if blob else None
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self.sessions or self._load(user_id) is not None
+
+    def __getitem__(self, user_id: int) -> Dict:
+        session = self.sessions.get(user_id)
+        if session is None:
+            session = self._load(user_id)
+            if session is None:
+                raise KeyError(user_id)
+        self.sessions.move_to_end(user_id)
+        self.last_access[user_id] = time.monotonic()
+        self.touched.add(user_id)
+        return session
+
+    def __setitem__(self, user_id: int, session: Dict):
+        # Новая сессия целиком заменяет старую, включая сохраненные маршруты
+        if self.backend is not None:
+            self.backend.delete(self._name(user_id))
+        self.saved_core.pop(user_id, None)
+        self.saved_routes.pop(user_id, None)
+        self.sessions[user_id] = session
+        self.sessions.move_to_end(user_id)
+        self.last_access[user_id] = time.monotonic()
+        self.touched.add(user_id)
+
+    def __delitem__(self, user_id: int):
+        self._forget(user_id)
+        if self.backend is not None:
+            self.backend.delete(self._name(user_id))
+
+    def _forget(self, user_id: int):
+        self.sessions.pop(user_id, None)
+        self.last_access.pop(user_id, None)
+        self.touched.discard(user_id)
+        self.saved_core.pop(user_id, None)
+        self.saved_routes.pop(user_id, None)
+
+    def __iter__(self) -> Iterator[int]:
+        known = set(self.sessions)
+        yield from known
+        if self.backend is None:
+            return
+        for name in self.backend.scan_iter(match="session:*"):
+            user_id = int(_text(name).split(":", 1)[1])
+            if user_id not in known:
+                yield user_id
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def save(self, user_id: int):
+        """Записать изменившиеся части сессии"""
+        session = self.sessions.get(user_id)
+        if session is None or self.backend is None:
+            return
+        
+        routes_info = session.get('routes_info') or {}
+        core = {key: value for key, value in session.items() if key not in self.TRANSIENT_FIELDS}
+        core_blob = pack_value(core)
+        digest = hashlib.sha1(core_blob).digest()
+        
+        mapping = {}
+        if digest != self.saved_core.get(user_id):
+            mapping["core"] = core_blob
+        saved = self.saved_routes.setdefault(user_id, {})
+        for driver_id, info in routes_info.items():
+            record = info.get('route')
+            if saved.get(driver_id) is not record:
+                mapping[f"route:{driver_id}"] = pack_value(record.polyline if record else "")
+        stale = [driver_id for driver_id in saved if driver_id not in routes_info]
+        
+        name = self._name(user_id)
+        if mapping:
+            self.backend.hset(name, mapping=mapping)
+        if stale:
+            self.backend.hdel(name, *(f"route:{driver_id}" for driver_id in stale))
+        
+        self.saved_core[user_id] = digest
+        for driver_id in stale:
+            saved.pop(driver_id)
+        for driver_id, info in routes_info.items():
+            saved[driver_id] = info.get('route')
+
+    def flush(self):
+        """Записать все сессии, к которым обращались с прошлой записи, и вытеснить лишние"""
+        touched, self.touched = self.touched, set()
+        for user_id in touched:
+            try:
+                self.save(user_id)
+            except Exception:
+                self.touched.add(user_id)  # повторим при следующей записи
+        self.evict()
+
+    def evict(self):
+        """Вытеснить сессии сверх SESSION_MAX_LIVE и простаивающие дольше SESSION_IDLE_TTL"""
+        if self.backend is None:
+            return  # вытесненную сессию некуда записать
+        idle_before = time.monotonic() - SESSION_IDLE_TTL
+        for user_id in list(self.sessions):
+            if len(self.sessions) <= SESSION_MAX_LIVE and self.last_access[user_id] > idle_before:
+                break  # дальше только более свежие сессии
+            if user_id in self.touched or user_id in self.pinned:
+                continue  # изменения еще не записаны или сессия используется
+            self._forget(user_id)
+            self.evictions += 1
+
+    def pin(self, user_id: int):
+        self.pinned[user_id] = self.pinned.get(user_id, 0) + 1
+
+    def unpin(self, user_id: int):
+        # Сессию могли изменить по ссылке, не обращаясь к user_data: записываем в любом случае
+        if user_id in self.sessions:
+            self.touched.add(user_id)
+        if self.pinned.get(user_id, 0) <= 1:
+            self.pinned.pop(user_id, None)
+        else:
+            self.pinned[user_id] -= 1
+
+    def session_size(self, user_id: int) -> int:
+        """Оценка объема сессии в памяти (байт)"""
+        return deep_sizeof(self.sessions[user_id]) if user_id in self.sessions else 0
+
+    def stats(self, top: int = 5) -> Dict:
+        now = time.monotonic()
+        sizes = {user_id: self.session_size(user_id) for user_id in self.sessions}
+        largest = sorted(sizes.items(), key=lambda item: item[1], reverse=True)[:top]
+        return {
+            'live': len(self.sessions),
+            'stored': len(self) if self.backend is not None else len(self.sessions),
+            'total_bytes': sum(sizes.values()),
+            'evictions': self.evictions,
+            'largest': [
+                (user_id, size, len(self.sessions[user_id].get('addresses') or []),
+                 now - self.last_access[user_id])
+                for user_id, size in largest
+            ]
+        }
+
+class HashFSMStorage(BaseStorage):
+    """Хранилище состояний FSM aiogram в том же хранилище хэшей, что и сессии"""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @staticmethod
+    def _name(key: StorageKey) -> str:
+        return f"fsm:{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or 0}:{key.destiny}"
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        if value is None:
+            self.backend.hdel(self._name(key), "state")
+        else:
+            self.backend.hset(self._name(key), mapping={"state": value})
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        value = self.backend.hget(self._name(key), "state")
+        return _text(value) if value is not None else None
+
+    async def set_data(self, key: StorageKey, data: Dict) -> None:
+        if not data:
+            self.backend.hdel(self._name(key), "data")
+        else:
+            self.backend.hset(self._name(key), mapping={"data": pack_value(data)})
+
+    async def get_data(self, key: StorageKey) -> Dict:
+        blob = self.backend.hget(self._name(key), "data")
+        return unpack_value(blob) if blob else {}
+
+    async def close(self) -> None:
+        # Хранилище общее с сессиями и закрывается в main() после их записи
+        pass
+
+class SessionMiddleware(BaseMiddleware):
+    """Записывает сессии, измененные при обработке апдейта
+    
+    Сессия автора апдейта закреплена на время обработки, чтобы ее не вытеснили
+    из памяти, пока обработчик держит на нее ссылку.
+    """
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None:
+            user_data.pin(user.id)
+        try:
+            return await handler(event, data)
+        finally:
+            if user is not None:
+                user_data.unpin(user.id)
+            save_sessions()
+
+def save_sessions():
+    user_data.flush()
+
+async def sweep_idle_sessions():
+    """Периодически записывать и вытеснять сессии, даже если апдейтов нет"""
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        save_sessions()
 
 # Инициализация
-storage = MemoryStorage()
-bot = Bot(token=TOKEN)
-dp = Dispatcher(storage=storage)
+if SESSION_BACKEND == "memory":
+    session_backend = None
+    storage = MemoryStorage()
+else:
+    session_backend = create_session_backend()
+    storage = HashFSMStorage(session_backend)
+user_data = SessionStore(session_backend)
 
-# Хранение данных пользователей
-user_data: Dict[int, Dict] = {}
+# Без токена бот не создается: служебные команды CLI работают и без него
+bot = Bot(token=TOKEN) if TOKEN else None
+dp = Dispatcher(storage=storage)
+dp.update.outer_middleware(SessionMiddleware())
 
 # Состояния для FSM
 class DistributionStates(StatesGroup):
     waiting_for_drivers = State()
+    choosing_engine = State()
     waiting_for_departure_time = State()
     setting_return_to_base = State()
 
@@ -257,107 +710,1028 @@ def clean_address(text):
     
     return res.strip(' ,.')
 
+# --- Скомпилированный движок нормализации адресов ---
+class AddressNormalizer:
+    """Та же логика, что в clean_address, но все шаблоны компилируются один раз"""
+
+    _I = re.IGNORECASE
+    BLOCK_PRIMARY = re.compile(r"Вид деятельности по ОКПД(.*?)Грузополучатель", re.DOTALL | re.IGNORECASE)
+    BLOCK_FALLBACK = re.compile(r"Грузополучатель(.*?)(?:Поставщик|Основание|Номер|Транспортная)", re.DOTALL | re.IGNORECASE)
+    QUOTES = re.compile(r'["«»]')
+    POSTCODE = re.compile(r'\b\d{6}\b')
+    JUNK = tuple(re.compile(p, re.IGNORECASE) for p in (
+        r'вн\.?тер\.?[^,]*',
+        r'муниципальный округ[^,]*',
+        r'\b(филиал|инн|кпп|бик|огрн|окпо)\b',
+        r'\b(ип|ооо|пао|ао|зао)\b.*?(?=москва|ул|пр|наб|$)',
+        r'\d{10,25}',
+        r'\b(р/с|к/с|рс|кс)\b.*',
+        r'банковские реквизиты.*',
+        r'тел\..*'
+    ))
+    ANCHOR = re.compile(r'(Москва|ул\.|ул\s|пр-т|проспект|наб|пер\.|бульвар|шоссе|пл\.)', re.IGNORECASE)
+
+    # Классификация частей адреса
+    CITY_PREFIX = re.compile(r'\b(г\.|г|город)\b\.?\s*', re.IGNORECASE)
+    PERSON_NAME = re.compile(r'^([А-ЯЁ][а-яё]+\s*){2,3}')
+    HOUSE_NUMBER = re.compile(r'^\d+[а-яА-Я]?$')
+    HOUSE_WITH_BLOCK = re.compile(r'^\d+к\d+$')
+    HOUSE_WITH_BUILDING = re.compile(r'^\d+\s*стр\.', re.IGNORECASE)
+    BUILDING = re.compile(r'^(к|корп|стр|строение|с)\.?\s*\d*', re.IGNORECASE)
+    STREET_TYPE = re.compile(r'\b(ул|улица|пр-т|проспект|пер|переулок|наб|набережная|б-р|бульвар|ш|шоссе)\b', re.IGNORECASE)
+    STREET_WORD = re.compile(r'\b(ул|улица)\b', re.IGNORECASE)
+    STARTS_WITH_DIGIT = re.compile(r'^\d')
+    HAS_STREET_TYPE = re.compile(r'\b(ул\.|проспект|пер\.|бульвар|шоссе|набережная|пл\.)\b', re.IGNORECASE)
+    LONG_WORD = re.compile(r'[а-яё]{3,}')
+    HOUSE_NUMBER_LOWER = re.compile(r'^\d+[а-я]?$')
+    BUILDING_PREFIX = re.compile(r'^(к|корп|стр|строение|с)', re.IGNORECASE)
+    STARTS_WITH_LETTER = re.compile(r'^[А-Яа-яёЁ]+')
+
+    # Финальное форматирование: (шаблон, замена) в порядке применения
+    FINAL_RULES = tuple((re.compile(p, f), r) for p, r, f in (
+        (r'ул\.\s+ул\.', 'ул.', re.IGNORECASE),
+        (r'ул\.\.', 'ул.', re.IGNORECASE),
+        (r'\bул\b(?!\.)', 'ул.', re.IGNORECASE),
+        (r'\bпер\b(?!\.)', 'пер.', re.IGNORECASE),
+        (r'\bпр-т\b', 'проспект', re.IGNORECASE),
+        (r'\bнаб\.\b', 'набережная', re.IGNORECASE),
+        (r'^д\.|^дом\s+', '', re.IGNORECASE),
+        (r',\s*д\.\s*', ', ', re.IGNORECASE),
+        (r',\s*дом\s*', ', ', re.IGNORECASE),
+        (r'\s+д\.\s+', ' ', re.IGNORECASE),
+        (r'\s+дом\s+', ' ', re.IGNORECASE),
+        (r'д\.(\d+)', r'\1', re.IGNORECASE),
+        (r'дом(\d+)', r'\1', re.IGNORECASE),
+        (r'(\d+[А-Яа-я]?)\s*[,]?\s*(?:корп\.?|к\.?|к)\s*(\d+)', r'\1к\2', re.IGNORECASE),
+        (r'(\d+[А-Яа-я]?)\s*[,]?\s*(?:стр\.?|строение|с\.?)\s*(\d+)', r'\1 стр. \2', re.IGNORECASE),
+        (r'(\d+)\s+([А-Яа-я])\b', r'\1\2', 0),
+        (r'([а-яА-ЯёЁ]{2,}(?:\s+[а-яА-ЯёЁ]+){0,3})\s+(\d+[а-яА-Я]?\d*(?:к\d+)?)', r'\1, \2', 0),
+        (r'\s+', ' ', 0),
+        (r'[,]{2,}', ',', 0),
+        (r',\s*,', ', ', 0),
+        (r',\s*(к\d+|стр\.\s*\d+)', r' \1', 0),
+        (r',\s*д\.\s*$', '', re.IGNORECASE),
+        (r'ул\.\s+(проспект|пер\.|бульвар|шоссе|набережная|пл\.)', r'\1', re.IGNORECASE),
+        (r'\b(проспект|ул\.|пер\.|бульвар|шоссе|набережная)\s+д\s*,', r'\1,', re.IGNORECASE),
+        (r'ул\.\.', 'ул.', 0),
+        (r',\s*,', ',', 0),
+    ))
+    WHITESPACE = re.compile(r'\s+')
+    LEADING_COMMA = re.compile(r'^,\s*')
+    MOSCOW_THEN_DIGIT = re.compile(r'^Москва,\s*\d')
+    AFTER_MOSCOW = re.compile(r'^Москва,\s*([^,]+)')
+    STREET_BEFORE_NUMBER = re.compile(r'([А-Яа-яёЁ]+\s+[А-Яа-яёЁ]+)(?=\s*\d)')
+
+    def normalize(self, text: str) -> Optional[str]:
+        """Адрес грузополучателя из текста накладной (результат идентичен clean_address)"""
+        match = self.BLOCK_PRIMARY.search(text)
+        if not match:
+            match = self.BLOCK_FALLBACK.search(text)
+        if not match:
+            return None
+        raw = match.group(1).replace('\n', ' ').strip()
+        
+        raw = self.QUOTES.sub('', raw)
+        raw = self.POSTCODE.sub('', raw)
+        for pattern in self.JUNK:
+            raw = pattern.sub('', raw)
+        
+        match_anchor = self.ANCHOR.search(raw)
+        if match_anchor:
+            raw = raw[match_anchor.start():]
+        
+        clean_parts = []
+        seen_moscow = False
+        street_detected = False
+        last_was_street_name = False
+        
+        for p in raw.split(','):
+            p_clean = self.CITY_PREFIX.sub('', p.strip())
+            if not p_clean:
+                continue
+            
+            if "москва" in p_clean.lower():
+                if not seen_moscow:
+                    clean_parts.append("Москва")
+                    seen_moscow = True
+                continue
+            
+            p_clean = self.PERSON_NAME.sub('', p_clean).strip()
+            if not p_clean:
+                continue
+            
+            if (self.HOUSE_NUMBER.match(p_clean) or self.HOUSE_WITH_BLOCK.match(p_clean)
+                    or self.HOUSE_WITH_BUILDING.match(p_clean) or self.BUILDING.match(p_clean)):
+                clean_parts.append(p_clean)
+                last_was_street_name = False
+                continue
+            
+            is_street_type = self.STREET_TYPE.search(p_clean)
+            if is_street_type:
+                if is_street_type.group(1).lower() in ('ул', 'улица'):
+                    p_clean = self.STREET_WORD.sub('ул.', p_clean)
+                clean_parts.append(p_clean)
+                street_detected = True
+                last_was_street_name = False
+                continue
+            
+            if not street_detected and not self.STARTS_WITH_DIGIT.match(p_clean):
+                if (not self.HAS_STREET_TYPE.search(p_clean)
+                        and self.LONG_WORD.search(p_clean.lower())
+                        and not self.HOUSE_NUMBER_LOWER.match(p_clean)
+                        and not self.BUILDING_PREFIX.match(p_clean)):
+                    p_clean = f"ул. {p_clean}"
+                    street_detected = True
+                    last_was_street_name = True
+            elif last_was_street_name and self.STARTS_WITH_LETTER.match(p_clean):
+                if clean_parts and clean_parts[-1].startswith('ул.'):
+                    clean_parts[-1] = clean_parts[-1] + ' ' + p_clean
+                    continue
+            
+            clean_parts.append(p_clean)
+            last_was_street_name = False
+        
+        res = ", ".join(clean_parts)
+        if not res.startswith("Москва"):
+            res = "Москва, " + res.lstrip(" ,")
+        
+        for pattern, replacement in self.FINAL_RULES:
+            res = pattern.sub(replacement, res)
+        res = self.WHITESPACE.sub(' ', res).strip()
+        res = self.LEADING_COMMA.sub('', res)
+        
+        if self.MOSCOW_THEN_DIGIT.match(res):
+            match = self.AFTER_MOSCOW.match(res)
+            if match:
+                after_moscow = match.group(1)
+                if self.STARTS_WITH_DIGIT.match(after_moscow):
+                    street_match = self.STREET_BEFORE_NUMBER.search(raw)
+                    if street_match:
+                        res = f"Москва, ул. {street_match.group(1)}, {after_moscow}"
+        
+        return res.strip(' ,.')
+
+    def normalize_batch(self, texts: Iterable[str]) -> List[Optional[str]]:
+        """Нормализовать много текстов накладных за один вызов"""
+        normalize = self.normalize
+        return [normalize(text) for text in texts]
+
+address_normalizer = AddressNormalizer()
+
+def verify_address_normalizer(texts: Iterable[str]) -> List[Tuple[str, Optional[str], Optional[str]]]:
+    """Сверить движок с эталонной clean_address; возвращает расхождения (текст, эталон, результат)"""
+    mismatches = []
+    for text in texts:
+        expected = clean_address(text)
+        actual = address_normalizer.normalize(text)
+        if expected != actual:
+            mismatches.append((text, expected, actual))
+    return mismatches
+
+def benchmark_address_normalizer(texts: List[str], repeat: int = 3) -> Dict[str, float]:
+    """Пропускная способность (адресов в секунду) clean_address и скомпилированного движка"""
+    def measure(fn) -> float:
+        best = float('inf')
+        for _ in range(repeat):
+            started = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - started)
+        return len(texts) / best if best > 0 else float('inf')
+    
+    return {
+        'texts': len(texts),
+        'reference_per_sec': measure(lambda: [clean_address(text) for text in texts]),
+        'compiled_per_sec': measure(lambda: address_normalizer.normalize_batch(texts)),
+    }
+
+# --- Разбор PDF в пуле процессов ---
+# Блоки грузополучателя: основной шаблон и запасной, как в clean_address
+CONSIGNEE_BLOCK_PATTERNS = (
+    re.compile(r"Вид деятельности по ОКПД(.*?)Грузополучатель", re.DOTALL | re.IGNORECASE),
+    re.compile(r"Грузополучатель(.*?)(?:Поставщик|Основание|Номер|Транспортная)", re.DOTALL | re.IGNORECASE),
+)
+CONSIGNEE_BLOCK_STARTS = (
+    re.compile(r"Вид деятельности по ОКПД", re.IGNORECASE),
+    re.compile(r"Грузополучатель", re.IGNORECASE),
+)
+CONSIGNEE_MAX_BLOCK_CHARS = int(os.getenv("CONSIGNEE_MAX_BLOCK_CHARS", 20000))
+
+def iter_consignee_blocks(page_texts: Iterable[str]) -> Iterator[str]:
+    """Потоково выделить все блоки грузополучателя из текста страниц
+    
+    Страницы склеиваются так же, как раньше ("".join), поэтому блоки могут
+    переходить через границу страниц. В памяти держится только хвост текста
+    с незавершенным блоком (не длиннее CONSIGNEE_MAX_BLOCK_CHARS).
+    
+    В скане за день подряд идут накладные обоих форматов, поэтому шаблон выбирается
+    для каждого блока: из найденных блоков берется тот, что заканчивается раньше.
+    В накладной основного формата это блок "ОКПД ... Грузополучатель", и его
+    "Грузополучатель" уже не начинает блок по запасному шаблону.
+    """
+    buffer = ""
+    positions = [0, 0]
+    
+    for page_text in page_texts:
+        buffer += page_text
+        
+        while True:
+            matches = [pattern.search(buffer, pos) for pattern, pos in zip(CONSIGNEE_BLOCK_PATTERNS, positions)]
+            found = [match for match in matches if match]
+            if not found:
+                break
+            # Блок, который закончится позже, целиком лежит дальше в тексте
+            block = min(found, key=lambda match: match.end())
+            positions = [max(pos, block.end()) for pos in positions]
+            yield block.group(0)
+        
+        # Оставляем только текст, с которого может начаться незавершенный блок
+        keep = len(buffer)
+        for k, start_pattern in enumerate(CONSIGNEE_BLOCK_STARTS):
+            while True:
+                start = start_pattern.search(buffer, positions[k])
+                if start and len(buffer) - start.start() > CONSIGNEE_MAX_BLOCK_CHARS:
+                    # Блок без окончания - пропускаем его начало
+                    positions[k] = start.end()
+                    continue
+                break
+            if start:
+                keep = min(keep, start.start())
+            else:
+                # Начало блока может оказаться разрезанным границей страниц
+                marker_tail = len(start_pattern.pattern) - 1
+                keep = min(keep, max(positions[k], len(buffer) - marker_tail))
+        
+        buffer = buffer[keep:]
+        positions = [max(0, pos - keep) for pos in positions]
+
+def _iter_page_texts(pdf) -> Iterator[str]:
+    for page in pdf.pages:
+        text = page.extract_text() or ""
+        # Сбрасываем кэш разобранных объектов страницы
+        page.close()
+        yield text
+
+def extract_addresses_from_pdf(source: Union[bytes, str]) -> List[str]:
+    """Извлечь адреса всех грузополучателей из PDF (выполняется в процессе-воркере)
+    
+    source - содержимое файла в памяти либо путь к файлу во временном каталоге.
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    
+    addresses = []
+    with pdfplumber.open(source) as pdf:
+        for block in iter_consignee_blocks(_iter_page_texts(pdf)):
+            addr = address_normalizer.normalize(block)
+            if addr and addr not in addresses:
+                addresses.append(addr)
+    return addresses
+
+pdf_executor = ProcessPoolExecutor(max_workers=PDF_WORKERS)
+# В пул отправляется не больше файлов, чем воркеров: PDF_PARSE_TIMEOUT отсчитывает
+# только время разбора, а не ожидание в очереди пула
+pdf_slots = asyncio.Semaphore(PDF_WORKERS)
+
+def recycle_pdf_executor(stuck: ProcessPoolExecutor):
+    """Заменить пул новым и завершить процессы старого: зависший воркер иначе занимает его навсегда"""
+    global pdf_executor
+    if pdf_executor is stuck:
+        pdf_executor = ProcessPoolExecutor(max_workers=PDF_WORKERS)
+    processes = list((stuck._processes or {}).values())
+    # Без cancel_futures: разбиравшиеся в пуле файлы получат BrokenProcessPool и будут повторены
+    stuck.shutdown(wait=False)
+    for process in processes:
+        if process.is_alive():
+            process.kill()
+
+async def parse_pdf(source: Union[bytes, str]) -> List[str]:
+    """Разобрать PDF в пуле процессов, не блокируя event loop
+    
+    Если разбор длится дольше PDF_PARSE_TIMEOUT, ожидание прерывается с
+    asyncio.TimeoutError, а пул пересоздается с завершением воркеров. Файлы, которые
+    в этот момент разбирались в том же пуле, получают BrokenProcessPool и один раз
+    повторяются в новом пуле.
+    """
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        async with pdf_slots:
+            executor = pdf_executor
+            try:
+                return await asyncio.wait_for(
+                    loop.run_in_executor(executor, extract_addresses_from_pdf, source),
+                    timeout=PDF_PARSE_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                recycle_pdf_executor(executor)
+                raise
+            except BrokenProcessPool:
+                # Пул сломан: его пересоздали из-за соседнего файла или упал воркер
+                recycle_pdf_executor(executor)
+                if attempt:
+                    raise
+
+# --- Кэш результатов разбора накладных ---
+# Фабрика контекста, отдающего содержимое документа (bytes) или путь к файлу
+DocumentLoader = Callable[[], AsyncContextManager[Union[bytes, str]]]
+
+# Увеличивать при любом изменении разбора PDF или нормализации адресов: старые записи кэша не используются
+PARSER_VERSION = 1
+
+class ParseResultCache:
+    """Адреса, извлеченные из PDF, по SHA-256 содержимого или file_unique_id Telegram и версии разбора"""
+
+    def __init__(self, path: str, version: int = PARSER_VERSION):
+        self.version = version
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS parse_results ("
+            "key TEXT PRIMARY KEY, addresses TEXT, created_at REAL)"
+        )
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[List[str]]:
+        row = self.conn.execute(
+            "SELECT addresses FROM parse_results WHERE key = ?", (f"v{self.version}:{key}",)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, addresses: List[str]):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO parse_results (key, addresses, created_at) VALUES (?, ?, ?)",
+            (f"v{self.version}:{key}", json.dumps(addresses, ensure_ascii=False), time.time())
+        )
+        self.conn.commit()
+
+    def count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM parse_results").fetchone()[0]
+
+parse_cache = ParseResultCache(os.path.join(DATA_DIR, "parse_cache.db"))
+
+def _sha256(source: Union[bytes, str]) -> str:
+    if isinstance(source, bytes):
+        return hashlib.sha256(source).hexdigest()
+    digest = hashlib.sha256()
+    with open(source, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+async def parse_document_cached(loader: DocumentLoader, file_unique_id: Optional[str] = None) -> List[str]:
+    """Разобрать документ, используя кэш по file_unique_id (без скачивания) и SHA-256"""
+    if file_unique_id:
+        cached = parse_cache.get(f"uid:{file_unique_id}")
+        if cached is not None:
+            parse_cache.hits += 1
+            return cached
+    
+    async with loader() as source:
+        sha_key = f"sha256:{_sha256(source)}"
+        addresses = parse_cache.get(sha_key)
+        if addresses is not None:
+            parse_cache.hits += 1
+        else:
+            parse_cache.misses += 1
+            addresses = await parse_pdf(source)
+            # Пустой результат мог быть таймаутом или ошибкой разбора - не кэшируем
+            if addresses:
+                parse_cache.set(sha_key, addresses)
+    
+    if file_unique_id and addresses:
+        parse_cache.set(f"uid:{file_unique_id}", addresses)
+    return addresses
+
+class DocumentTooLarge(Exception):
+    pass
+
+_spill_dir: Optional[str] = None
+
+def get_spill_dir() -> str:
+    """Приватный (0700) временный каталог для файлов, не помещающихся в память"""
+    global _spill_dir
+    if _spill_dir is None or not os.path.isdir(_spill_dir):
+        _spill_dir = tempfile.mkdtemp(prefix="logistics_bot_")
+    return _spill_dir
+
+@asynccontextmanager
+async def downloaded_document(document: types.Document) -> AsyncIterator[Union[bytes, str]]:
+    """Скачать документ Telegram в память (крупные файлы - во временный каталог)"""
+    size = document.file_size or 0
+    if size > PDF_MAX_SIZE:
+        raise DocumentTooLarge(f"файл больше {PDF_MAX_SIZE // (1024 * 1024)} МБ")
+    
+    file = await bot.get_file(document.file_id)
+    if size <= PDF_MEMORY_LIMIT:
+        buffer = await bot.download_file(file.file_path)
+        data = buffer.getvalue()
+        if len(data) > PDF_MAX_SIZE:
+            raise DocumentTooLarge(f"файл больше {PDF_MAX_SIZE // (1024 * 1024)} МБ")
+        yield data
+        return
+    
+    path = os.path.join(get_spill_dir(), f"{uuid.uuid4()}.pdf")
+    try:
+        await bot.download_file(file.file_path, path)
+        yield path
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+# --- Общий пул HTTP-соединений ---
+http_session: Optional[aiohttp.ClientSession] = None
+http_pool_stats = {'requests': 0, 'connections_created': 0, 'connections_reused': 0}
+
+async def _on_request_start(session, ctx, params):
+    http_pool_stats['requests'] += 1
+
+async def _on_connection_create_end(session, ctx, params):
+    http_pool_stats['connections_created'] += 1
+
+async def _on_connection_reuseconn(session, ctx, params):
+    http_pool_stats['connections_reused'] += 1
+
+def create_http_session() -> aiohttp.ClientSession:
+    """Создать общую сессию с пулом соединений, keep-alive и кэшем DNS"""
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_connection_create_end.append(_on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(_on_connection_reuseconn)
+    
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        use_dns_cache=True
+    )
+    return aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Общая сессия процесса (создается в main(), здесь - на случай вызова до старта)"""
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = create_http_session()
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+def get_http_pool_stats() -> Dict:
+    """Статистика пула: сколько соединений создано и сколько раз переиспользовано"""
+    stats = dict(http_pool_stats)
+    connector = http_session.connector if http_session is not None and not http_session.closed else None
+    # Свободные keep-alive соединения, ожидающие повторного использования
+    stats['idle_connections'] = sum(len(conns) for conns in connector._conns.values()) if connector is not None else 0
+    opened = stats['connections_created'] + stats['connections_reused']
+    stats['reuse_ratio'] = stats['connections_reused'] / opened if opened else 0.0
+    return stats
+
+# --- Постоянный кэш геокодирования ---
+class GeocodeCache:
+    """Кэш координат в SQLite, общий для всех пользователей"""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS geocode ("
+            "key TEXT PRIMARY KEY, lat REAL, lon REAL, provider TEXT, created_at REAL)"
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def normalize(address: str) -> str:
+        """Ключ кэша: результат clean_address без различий в регистре и пробелах"""
+        return re.sub(r'\s+', ' ', address).strip(' ,.').lower()
+
+    def get(self, address: str) -> Tuple[bool, Optional[Tuple[float, float]]]:
+        """Возвращает (найдено в кэше, координаты); None - закэшированная неудача"""
+        row = self.conn.execute(
+            "SELECT lat, lon, created_at FROM geocode WHERE key = ?",
+            (self.normalize(address),)
+        ).fetchone()
+        if not row:
+            return False, None
+        
+        lat, lon, created_at = row
+        ttl = GEOCODE_CACHE_TTL if lat is not None else GEOCODE_NEGATIVE_TTL
+        if time.time() - created_at > ttl:
+            return False, None
+        
+        return True, ((lat, lon) if lat is not None else None)
+
+    def set(self, address: str, coords: Optional[Tuple[float, float]], provider: Optional[str]):
+        """Сохранить результат геокодирования (coords=None - отрицательный результат)"""
+        lat, lon = coords if coords else (None, None)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO geocode (key, lat, lon, provider, created_at) VALUES (?, ?, ?, ?, ?)",
+            (self.normalize(address), lat, lon, provider, time.time())
+        )
+        self.conn.commit()
+
+    def count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM geocode").fetchone()[0]
+
+geocode_cache = GeocodeCache(os.path.join(DATA_DIR, "geocode_cache.db"))
+
+# --- Ограничение частоты запросов к внешним API ---
+class TokenBucket:
+    """Асинхронный token bucket: не более rate запросов в секунду"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+tomtom_limiter = TokenBucket(TOMTOM_RPS)
+# Политика Nominatim: не более 1 запроса в секунду, без всплесков
+nominatim_limiter = TokenBucket(NOMINATIM_RPS, capacity=1)
+
+# Синхронный geopy выполняется в отдельном потоке, чтобы не блокировать event loop
+nominatim_geolocator = Nominatim(user_agent="logistics_bot_v4", timeout=10)
+nominatim_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="nominatim")
+
 # --- Геокодирование через несколько сервисов ---
+class GeocodeError(Exception):
+    """Сервис не ответил (сеть, таймаут, лимит, ошибка сервера), в отличие от ответа «не найдено»"""
+    pass
+
 async def geocode_with_fallback(address: str) -> Optional[Tuple[float, float]]:
-    """Геокодирование через TomTom, с fallback на Nominatim"""
-    coords = await tomtom_geocode(address)
+    """Геокодирование через TomTom, с fallback на Nominatim и кэшем результатов"""
+    cached, coords = geocode_cache.get(address)
+    if cached:
+        return coords
+    
+    tomtom_failed = False
+    try:
+        coords = await tomtom_geocode(address)
+    except GeocodeError:
+        coords, tomtom_failed = None, True
     if coords:
+        geocode_cache.set(address, coords, "tomtom")
         return coords
     
-    coords = await nominatim_geocode(address)
+    return await nominatim_geocode_cached(address, cache_negative=not tomtom_failed)
+
+async def nominatim_geocode_cached(address: str, cache_negative: bool = True) -> Optional[Tuple[float, float]]:
+    """Fallback через Nominatim с записью результата в кэш
+    
+    Неудача кэшируется, только если Nominatim ответил "не найдено" и cache_negative
+    (TomTom тоже ответил, а не упал): сбой сервиса не должен закрывать адрес на
+    GEOCODE_NEGATIVE_TTL.
+    """
+    try:
+        coords = await nominatim_geocode(address)
+    except GeocodeError:
+        return None
+    if coords or cache_negative:
+        geocode_cache.set(address, coords, "nominatim" if coords else None)
     return coords
 
+TOMTOM_GEOCODE_PARAMS = {
+    "limit": 1,
+    "countrySet": "RU",
+    "language": "ru-RU",
+    "typeahead": "false"
+}
+
+def parse_tomtom_geocode_response(data: Dict) -> Optional[Tuple[float, float]]:
+    """Координаты первого результата ответа TomTom Geocode"""
+    if data.get("results") and len(data["results"]) > 0:
+        position = data["results"][0]["position"]
+        return (position["lat"], position["lon"])
+    return None
+
 async def tomtom_geocode(address: str) -> Optional[Tuple[float, float]]:
-    """Геокодирование адреса с помощью TomTom API"""
+    """Геокодирование адреса с помощью TomTom API: None - не найдено, GeocodeError - нет ответа"""
     try:
-        encoded_address = aiohttp.helpers.quote(address)
-        url = f"https://api.tomtom.com/search/2/geocode/{encoded_address}.json"
-        params = {
-            "key": TOMTOM_API_KEY,
-            "limit": 1,
-            "countrySet": "RU",
-            "language": "ru-RU",
-            "typeahead": "false"
-        }
+        encoded_address = quote(address)
+        url = f"{TOMTOM_BASE_URL}/search/2/geocode/{encoded_address}.json"
+        params = {"key": TOMTOM_API_KEY, **TOMTOM_GEOCODE_PARAMS}
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params, timeout=10) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if data.get("results") and len(data["results"]) > 0:
-                        position = data["results"][0]["position"]
-                        return (position["lat"], position["lon"])
-        return None
-    except Exception:
-        return None
+        await tomtom_limiter.acquire()
+        session = get_http_session()
+        async with session.get(url, params=params, timeout=10) as response:
+            if response.status == 200:
+                return parse_tomtom_geocode_response(await response.json())
+            raise GeocodeError(f"TomTom {response.status}")
+    except GeocodeError:
+        raise
+    except Exception as e:
+        raise GeocodeError(type(e).__name__) from e
+
+async def tomtom_batch_geocode(addresses: List[str]) -> Tuple[Dict[str, Tuple[float, float]], List[str]]:
+    """Геокодирование списка адресов через TomTom Batch Search
+    
+    До TOMTOM_BATCH_SYNC_LIMIT адресов отправляются синхронным batch-запросом,
+    больше - асинхронным (с ожиданием результата по ссылке из Location).
+    Возвращает координаты найденных адресов и список адресов без ответа: batch-запрос
+    не выполнился, ответ короче запроса или элемент вернулся с ошибкой (их стоит
+    геокодировать поштучно).
+    """
+    coords_dict = {}
+    unanswered = []
+    query_string = urlencode(TOMTOM_GEOCODE_PARAMS)
+    
+    for start in range(0, len(addresses), TOMTOM_BATCH_MAX_ITEMS):
+        chunk = addresses[start:start + TOMTOM_BATCH_MAX_ITEMS]
+        body = {"batchItems": [
+            {"query": f"/geocode/{quote(address)}.json?{query_string}"} for address in chunk
+        ]}
+        try:
+            if len(chunk) <= TOMTOM_BATCH_SYNC_LIMIT:
+                data = await _tomtom_batch_sync(body)
+            else:
+                data = await _tomtom_batch_async(body)
+        except Exception:
+            unanswered.extend(chunk)
+            continue
+        
+        items = data.get("batchItems", [])
+        # Адреса, для которых в ответе нет элемента, иначе молча потерялись бы в zip
+        unanswered.extend(chunk[len(items):])
+        for address, item in zip(chunk, items):
+            if item.get("statusCode") != 200:
+                unanswered.append(address)  # ошибка запроса, а не ответ "не найдено"
+                continue
+            coords = parse_tomtom_geocode_response(item.get("response", {}))
+            if coords:
+                coords_dict[address] = coords
+    
+    return coords_dict, unanswered
+
+async def _tomtom_batch_sync(body: Dict) -> Dict:
+    await tomtom_limiter.acquire()
+    session = get_http_session()
+    url = f"{TOMTOM_BASE_URL}/search/2/batch/sync.json"
+    async with session.post(url, params={"key": TOMTOM_API_KEY}, json=body,
+                            timeout=TOMTOM_BATCH_TIMEOUT) as response:
+        response.raise_for_status()
+        return await response.json()
+
+async def _tomtom_batch_async(body: Dict) -> Dict:
+    session = get_http_session()
+    deadline = time.monotonic() + TOMTOM_BATCH_TIMEOUT
+    
+    await tomtom_limiter.acquire()
+    url = f"{TOMTOM_BASE_URL}/search/2/batch.json"
+    params = {"key": TOMTOM_API_KEY, "redirectMode": "manual", "waitTimeSeconds": 120}
+    async with session.post(url, params=params, json=body, allow_redirects=False,
+                            timeout=TOMTOM_BATCH_TIMEOUT) as response:
+        if response.status == 200:
+            return await response.json()
+        if response.status not in (202, 303):
+            response.raise_for_status()
+        location = response.headers["Location"]
+    
+    # Ждем результат по ссылке на скачивание (202 - пакет еще обрабатывается)
+    download_url = urljoin(TOMTOM_BASE_URL + "/", location)
+    download_params = {} if "key=" in download_url else {"key": TOMTOM_API_KEY}
+    while time.monotonic() < deadline:
+        await tomtom_limiter.acquire()
+        async with session.get(download_url, params=download_params,
+                               timeout=TOMTOM_BATCH_TIMEOUT) as response:
+            if response.status == 200:
+                return await response.json()
+            if response.status != 202:
+                response.raise_for_status()
+            download_url = urljoin(download_url, response.headers.get("Location", download_url))
+        await asyncio.sleep(1)
+    
+    raise asyncio.TimeoutError("TomTom batch geocoding timed out")
 
 async def nominatim_geocode(address: str) -> Optional[Tuple[float, float]]:
-    """Геокодирование через Nominatim как fallback"""
+    """Геокодирование через Nominatim как fallback: None - не найдено, GeocodeError - нет ответа"""
     try:
         if "Москва" not in address:
             address_to_geocode = f"Москва, {address}"
         else:
             address_to_geocode = address
-            
-        geolocator = Nominatim(user_agent="logistics_bot_v4", timeout=10)
-        location = geolocator.geocode(address_to_geocode)
+        
+        await nominatim_limiter.acquire()
+        loop = asyncio.get_running_loop()
+        location = await loop.run_in_executor(
+            nominatim_executor, nominatim_geolocator.geocode, address_to_geocode
+        )
         if location:
             return (location.latitude, location.longitude)
         return None
-    except Exception:
-        return None
+    except Exception as e:
+        raise GeocodeError(type(e).__name__) from e
 
-async def batch_geocode(addresses: List[str]) -> Tuple[Dict[str, Tuple[float, float]], List[str]]:
-    """Пакетное геокодирование адресов"""
+GeocodeCallback = Callable[[str, Optional[Tuple[float, float]], int, int], Awaitable[None]]
+
+async def batch_geocode(addresses: List[str],
+                        on_result: Optional[GeocodeCallback] = None,
+                        mode: Optional[str] = None
+                        ) -> Tuple[Dict[str, Tuple[float, float]], List[str]]:
+    """Пакетное параллельное геокодирование адресов
+    
+    Одновременно выполняется не более GEOCODE_CONCURRENCY запросов, частоту
+    обращений к каждому сервису ограничивают tomtom_limiter и nominatim_limiter.
+    В режиме mode="batch" (по умолчанию GEOCODE_MODE) все не закэшированные адреса
+    отправляются в TomTom одним Batch Search запросом, а через Nominatim
+    догеокодируются только неудачные.
+    on_result(address, coords, done, total) вызывается по мере готовности адресов,
+    а результаты возвращаются в порядке входного списка.
+    """
+    results: Dict[str, Optional[Tuple[float, float]]] = {}
+    done = 0
+    
+    async def report(address: str, coords: Optional[Tuple[float, float]]):
+        nonlocal done
+        results[address] = coords
+        done += 1
+        if on_result:
+            await on_result(address, coords, done, len(addresses))
+    
+    batch_mode = (mode or GEOCODE_MODE) == "batch"
+    pending = list(addresses)
+    unanswered = set()
+    if batch_mode:
+        pending = []
+        for address in addresses:
+            cached, coords = geocode_cache.get(address)
+            if cached:
+                await report(address, coords)
+            else:
+                pending.append(address)
+        
+        found, unanswered = await tomtom_batch_geocode(pending)
+        unanswered = set(unanswered)
+        for address in pending:
+            if address in found:
+                geocode_cache.set(address, found[address], "tomtom")
+                await report(address, found[address])
+        
+        pending = [address for address in pending if address not in found]
+    
+    semaphore = asyncio.Semaphore(GEOCODE_CONCURRENCY)
+    
+    async def geocode_one(address: str):
+        async with semaphore:
+            # После batch-запроса TomTom уже ответил "не найдено" - остается Nominatim
+            if batch_mode and address not in unanswered:
+                return address, await nominatim_geocode_cached(address)
+            return address, await geocode_with_fallback(address)
+    
+    tasks = [asyncio.create_task(geocode_one(address)) for address in pending]
+    try:
+        for future in asyncio.as_completed(tasks):
+            await report(*(await future))
+    finally:
+        for task in tasks:
+            task.cancel()
+    
     coords_dict = {}
     failed_addresses = []
-    
-    for i, address in enumerate(addresses):
-        coords = await geocode_with_fallback(address)
+    for address in addresses:
+        coords = results.get(address)
         if coords:
             coords_dict[address] = coords
         else:
             failed_addresses.append(address)
-        await asyncio.sleep(0.2)
     
     return coords_dict, failed_addresses
 
 # --- TomTom Routing API с оптимизацией порядка ---
-async def tomtom_calculate_optimized_route(waypoints: List[Tuple[float, float]], 
-                                          departure_time: Optional[str] = None,
-                                          return_to_start: bool = False) -> Dict:
-    """Расчет оптимального маршрута с оптимизацией порядка точек"""
+# Профиль грузовика, общий для расчета маршрутов и матриц времени в пути
+TRUCK_PROFILE = {
+    "travelMode": "truck",
+    "vehicleMaxSpeed": 90,
+    "vehicleWeight": 3500,
+    "vehicleLength": 6,
+    "vehicleWidth": 2.5,
+    "vehicleHeight": 3.5,
+    "vehicleCommercial": "true",
+    "vehicleLoadType": "generalGoods"
+}
+
+def encode_polyline(points: Iterable[Tuple[float, float]], precision: int = 5) -> str:
+    """Закодировать координаты в строку (алгоритм Google Encoded Polyline)"""
+    factor = 10 ** precision
+    result = []
+    prev_lat = prev_lon = 0
+    for lat, lon in points:
+        lat, lon = int(round(lat * factor)), int(round(lon * factor))
+        for delta in (lat - prev_lat, lon - prev_lon):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                result.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            result.append(chr(value + 63))
+        prev_lat, prev_lon = lat, lon
+    return "".join(result)
+
+def decode_polyline(encoded: str, precision: int = 5) -> List[Tuple[float, float]]:
+    factor = 10 ** precision
+    points = []
+    index = lat = lon = 0
+    while index < len(encoded):
+        deltas = []
+        for _ in range(2):
+            shift = value = 0
+            while True:
+                byte = ord(encoded[index]) - 63
+                index += 1
+                value |= (byte & 0x1f) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            deltas.append(~(value >> 1) if value & 1 else value >> 1)
+        lat += deltas[0]
+        lon += deltas[1]
+        points.append((lat / factor, lon / factor))
+    return points
+
+class RouteRecord:
+    """Компактный результат calculateRoute: сводка, время и длина плеч, закодированная линия
+    
+    Текстовые инструкции не хранятся и запрашиваются отдельно (get_route_guidance).
+    Линия маршрута может подгружаться из хранилища сессий при первом обращении.
+    """
+    __slots__ = ('summary', 'legs', '_polyline', '_polyline_loader')
+
+    SUMMARY_FIELDS = ('lengthInMeters', 'travelTimeInSeconds', 'trafficDelayInSeconds',
+                      'departureTime', 'arrivalTime')
+
+    def __init__(self, summary: Dict, legs: List[Tuple[int, int]],
+                 polyline: Optional[str] = None,
+                 polyline_loader: Optional[Callable[[], Optional[str]]] = None):
+        self.summary = summary
+        self.legs = legs  # (метры, секунды) для каждого плеча
+        self._polyline = polyline
+        self._polyline_loader = polyline_loader
+
+    @classmethod
+    def from_tomtom(cls, data: Dict) -> Optional["RouteRecord"]:
+        routes = data.get("routes") or []
+        if not routes:
+            return None
+        route = routes[0]
+        summary = {key: route.get("summary", {})[key] for key in cls.SUMMARY_FIELDS if key in route.get("summary", {})}
+        legs = []
+        points = []
+        for leg in route.get("legs", []):
+            leg_summary = leg.get("summary", {})
+            legs.append((leg_summary.get("lengthInMeters", 0), leg_summary.get("travelTimeInSeconds", 0)))
+            points.extend((p["latitude"], p["longitude"]) for p in leg.get("points", []))
+        return cls(summary, legs, encode_polyline(points))
+
+    @property
+    def polyline(self) -> str:
+        if self._polyline is None and self._polyline_loader is not None:
+            self._polyline = self._polyline_loader() or ""
+            self._polyline_loader = None
+        return self._polyline or ""
+
+    def points(self) -> List[Tuple[float, float]]:
+        return decode_polyline(self.polyline)
+
+    def to_dict(self, with_polyline: bool = True) -> Dict:
+        data = {'summary': self.summary, 'legs': self.legs}
+        if with_polyline:
+            data['polyline'] = self.polyline
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict, polyline_loader: Optional[Callable[[], Optional[str]]] = None) -> "RouteRecord":
+        return cls(data.get('summary', {}), [tuple(leg) for leg in data.get('legs', [])],
+                   data.get('polyline'), polyline_loader)
+
+def deep_sizeof(obj, seen: Optional[Set[int]] = None) -> int:
+    """Приблизительный объем объекта в памяти вместе со всеми вложенными объектами"""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        return sys.getsizeof(obj)  # для массивов с собственными данными включает буфер
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, '__dict__'):
+        size += deep_sizeof(vars(obj), seen)
+    elif hasattr(obj, '__slots__'):
+        size += sum(deep_sizeof(getattr(obj, slot), seen) for slot in obj.__slots__ if hasattr(obj, slot))
+    return size
+
+def route_memory_report(data: Dict) -> Dict[str, int]:
+    """Объем в памяти полного ответа calculateRoute и его RouteRecord"""
+    record = RouteRecord.from_tomtom(data)
+    return {
+        'raw_bytes': deep_sizeof(data),
+        'record_bytes': deep_sizeof(record) if record else 0,
+        'points': len(record.points()) if record else 0
+    }
+
+class RouteCache:
+    """LRU-кэш ответов TomTom calculateRoute в памяти с ограничением по объему
+    
+    Ответы хранятся сжатым JSON: объем считается точно, а каждый вызов get
+    возвращает независимую копию.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(waypoints: List[Tuple[float, float]], departure_time: Optional[str], return_to_start: bool,
+            guidance: bool = False) -> str:
+        """Ключ: точки в порядке объезда, дата и время отправления с точностью до ROUTE_CACHE_BUCKET_MINUTES"""
+        try:
+            departure_dt = datetime.fromisoformat(departure_time) if departure_time else datetime.now()
+        except ValueError:
+            departure_dt = datetime.now()
+        minutes = departure_dt.hour * 60 + departure_dt.minute
+        minutes -= minutes % ROUTE_CACHE_BUCKET_MINUTES
+        points = ":".join(f"{lat:.6f},{lon:.6f}" for lat, lon in waypoints)
+        return (f"{departure_dt.date()}T{minutes // 60:02d}{minutes % 60:02d}"
+                f"|{int(return_to_start)}{int(guidance)}|{points}")
+
+    def get(self, key: str) -> Optional[Dict]:
+        blob = self.entries.get(key)
+        if blob is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return json.loads(zlib.decompress(blob))
+
+    def set(self, key: str, data: Dict):
+        blob = zlib.compress(json.dumps(data, ensure_ascii=False).encode("utf-8"), 1)
+        if len(blob) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        self.entries[key] = blob
+        self.size += len(blob)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+route_cache = RouteCache(int(ROUTE_CACHE_MAX_MB * 1024 * 1024))
+
+async def tomtom_route_request(waypoints: List[Tuple[float, float]],
+                               departure_time: Optional[str] = None,
+                               return_to_start: bool = False,
+                               guidance: bool = False) -> Tuple[Dict, Optional[str]]:
+    """Запрос маршрута TomTom: (ответ, None) или ({}, описание ошибки)
+    
+    Текстовые инструкции (guidance) тяжелые и запрашиваются только по необходимости.
+    """
     try:
         if len(waypoints) < 2:
-            return {}
+            return {}, "недостаточно точек"
         
         # Если требуется возврат, добавляем стартовую точку в конец
         if return_to_start:
-            final_waypoints = waypoints.copy()
+            final_waypoints = list(waypoints) + [waypoints[0]]
         else:
             final_waypoints = waypoints
         
         # Форматируем waypoints для API
         waypoints_str = ":".join([f"{lat},{lon}" for lat, lon in final_waypoints])
         
-        url = f"https://api.tomtom.com/routing/1/calculateRoute/{waypoints_str}/json"
+        # Порядок точек уже решен локально (solve_route_order), TomTom его не меняет:
+        # иначе legs, waypoints и addresses разошлись бы между собой
+        url = f"{TOMTOM_BASE_URL}/routing/1/calculateRoute/{waypoints_str}/json"
         params = {
             "key": TOMTOM_API_KEY,
-            "travelMode": "truck",
-            "vehicleMaxSpeed": 90,
-            "vehicleWeight": 3500,
-            "vehicleLength": 6,
-            "vehicleWidth": 2.5,
-            "vehicleHeight": 3.5,
+            **TRUCK_PROFILE,
             "routeType": "fastest",
             "traffic": "true",
-            "computeBestOrder": "true",  # Оптимизация порядка точек
-            "instructionsType": "text",
             "language": "ru-RU",
-            "vehicleCommercial": "true",
-            "vehicleLoadType": "generalGoods",
             "avoid": "unpavedRoads"
         }
+        if guidance:
+            params["instructionsType"] = "text"
         
         if departure_time:
             try:
@@ -368,69 +1742,579 @@ async def tomtom_calculate_optimized_route(waypoints: List[Tuple[float, float]],
             except:
                 pass
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params, timeout=30) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    
-                    # Извлекаем оптимизированный порядок точек
-                    if data.get("optimizedWaypoints"):
-                        optimized_order = [wp["optimizedIndex"] for wp in data["optimizedWaypoints"]]
-                        data["optimizedOrder"] = optimized_order
-                    
-                    return data
-                else:
-                    return {}
-    except Exception:
-        return {}
+        cache_key = RouteCache.key(final_waypoints, departure_time, return_to_start, guidance)
+        cached = route_cache.get(cache_key)
+        if cached is not None:
+            return cached, None
+        
+        await tomtom_limiter.acquire()
+        session = get_http_session()
+        async with session.get(url, params=params, timeout=ROUTE_TIMEOUT) as response:
+            if response.status == 200:
+                data = await response.json()
+                route_cache.set(cache_key, data)
+                return data, None
+            else:
+                try:
+                    detail = (await response.json()).get("detailedError", {}).get("message")
+                except Exception:
+                    detail = None
+                return {}, f"TomTom {response.status}" + (f": {detail}" if detail else "")
+    except asyncio.TimeoutError:
+        return {}, f"нет ответа TomTom за {ROUTE_TIMEOUT} с"
+    except Exception as e:
+        return {}, f"ошибка запроса ({type(e).__name__})"
+
+RouteCallback = Callable[[int, Dict, int, int], Awaitable[None]]
+
+async def calculate_routes(routes_info: Dict[int, Dict],
+                           driver_ids: Iterable[int],
+                           departure_time: Optional[str],
+                           on_result: Optional[RouteCallback] = None) -> None:
+    """Рассчитать маршруты водителей через TomTom параллельно
+    
+    Одновременно выполняется не более ROUTE_CONCURRENCY запросов. Для каждого
+    маршрута используются info['waypoints'] и info['return_to_base']; по мере
+    поступления ответов заполняются route (RouteRecord), route_status ("ok"/"failed") и
+    route_error, после чего вызывается on_result(driver_id, info, готово, всего).
+    """
+    driver_ids = [d for d in driver_ids if len(routes_info[d].get('waypoints', [])) > 1]
+    semaphore = asyncio.Semaphore(ROUTE_CONCURRENCY)
+    done = 0
+    
+    async def calculate(driver_id: int):
+        nonlocal done
+        info = routes_info[driver_id]
+        waypoints = info['waypoints']
+        async with semaphore:
+            route_data, error = await tomtom_route_request(
+                waypoints, departure_time, return_to_start=info.get('return_to_base', False)
+            )
+        # Пока ждали ответ, маршрут могли изменить - устаревший результат не записываем
+        if routes_info.get(driver_id) is info and info['waypoints'] is waypoints:
+            info['route'] = RouteRecord.from_tomtom(route_data) if route_data else None
+            info['route_status'] = "failed" if error else "ok"
+            info['route_error'] = error
+        done += 1
+        if on_result:
+            await on_result(driver_id, info, done, len(driver_ids))
+    
+    await asyncio.gather(*(calculate(driver_id) for driver_id in driver_ids))
+
+# --- Матрица расстояний ---
+EARTH_RADIUS_KM = 6371.0088
+
+def haversine_matrix(a, b=None) -> np.ndarray:
+    """Попарные расстояния (км) по дуге большого круга между точками (lat, lon)"""
+    a = np.radians(np.asarray(a, dtype=float).reshape(-1, 2))
+    b = a if b is None else np.radians(np.asarray(b, dtype=float).reshape(-1, 2))
+    lat1, lon1 = a[:, 0][:, None], a[:, 1][:, None]
+    lat2, lon2 = b[:, 0][None, :], b[:, 1][None, :]
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+def project_local(coords, origin: Tuple[float, float]) -> np.ndarray:
+    """Локальная равнопромежуточная проекция (км) вокруг origin для планарных алгоритмов"""
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    lat0 = np.radians(origin[0])
+    y = (coords[:, 0] - origin[0]) * np.pi / 180 * EARTH_RADIUS_KM
+    x = (coords[:, 1] - origin[1]) * np.pi / 180 * EARTH_RADIUS_KM * np.cos(lat0)
+    return np.column_stack([x, y])
+
+class DistanceMatrix:
+    """Расстояния между производством (индекс 0) и всеми адресами доставки сессии"""
+
+    def __init__(self, production_coords: Tuple[float, float], address_coords: Dict[str, Tuple[float, float]]):
+        self.production_coords = tuple(production_coords)
+        self.addresses = list(address_coords)
+        self.index = {addr: i for i, addr in enumerate(self.addresses, 1)}
+        self.coords = np.array([production_coords] + [address_coords[addr] for addr in self.addresses], dtype=float)
+        self.km = haversine_matrix(self.coords)
+        # Время (с) и расстояние (м) по дорогам, если подключена матрица TomTom
+        self.road_seconds: Optional[np.ndarray] = None
+        self.road_meters: Optional[np.ndarray] = None
+        self.road_bucket: Optional[str] = None
+
+    @property
+    def cost(self) -> np.ndarray:
+        """Стоимость переезда для кластеризации и порядка: время по дорогам или км по прямой"""
+        return self.road_seconds if self.road_seconds is not None else self.km
+
+    def matches(self, production_coords: Tuple[float, float], address_coords: Dict[str, Tuple[float, float]]) -> bool:
+        """Актуальна ли матрица для текущих координат сессии"""
+        if tuple(production_coords) != self.production_coords or len(address_coords) != len(self.addresses):
+            return False
+        return all(
+            addr in self.index and tuple(self.coords[self.index[addr]]) == tuple(coords)
+            for addr, coords in address_coords.items()
+        )
+
+    def indices(self, addresses: List[str]) -> np.ndarray:
+        return np.array([self.index[addr] for addr in addresses], dtype=int)
+
+def get_distance_matrix(user_id: int) -> Optional[DistanceMatrix]:
+    """Матрица расстояний сессии: строится один раз и хранится в user_data"""
+    session = user_data[user_id]
+    production_coords = session.get('production_coords')
+    address_coords = session.get('address_coords') or {}
+    if not production_coords or not address_coords:
+        return None
+    # Для очень больших сессий полная матрица не хранится - считаем по маршрутам
+    if len(address_coords) + 1 > DISTANCE_MATRIX_MAX_POINTS:
+        return None
+    
+    matrix = session.get('distance_matrix')
+    if matrix is None or not matrix.matches(production_coords, address_coords):
+        matrix = DistanceMatrix(production_coords, address_coords)
+        session['distance_matrix'] = matrix
+    return matrix
+
+def route_distance_matrix(start_coords: Tuple[float, float],
+                          points: List[Tuple[str, Tuple[float, float]]],
+                          matrix: Optional[DistanceMatrix] = None) -> np.ndarray:
+    """Матрица стоимостей маршрута: индекс 0 - старт, далее точки в порядке points"""
+    if (matrix is not None and tuple(start_coords) == matrix.production_coords
+            and all(addr in matrix.index for addr, _ in points)):
+        idx = np.concatenate([[0], matrix.indices([addr for addr, _ in points])])
+        cost = matrix.cost[np.ix_(idx, idx)]
+        # Время по дорогам несимметрично; 2-opt и Or-opt рассчитаны на симметричную матрицу
+        return (cost + cost.T) / 2 if matrix.road_seconds is not None else cost
+    return haversine_matrix([start_coords] + [coords for _, coords in points])
 
 def optimize_route_nearest_neighbor(start_coords: Tuple[float, float], 
-                                   points: List[Tuple[str, Tuple[float, float]]]) -> List[str]:
+                                   points: List[Tuple[str, Tuple[float, float]]],
+                                   matrix: Optional[DistanceMatrix] = None) -> List[str]:
     """Оптимизация маршрута алгоритмом ближайшего соседа"""
     if not points:
         return []
     
-    # Преобразуем в numpy для вычислений
-    import numpy as np
-    
-    point_coords = np.array([coord for _, coord in points])
+    dist = route_distance_matrix(start_coords, points, matrix)
     point_addresses = [addr for addr, _ in points]
     
-    unvisited = set(range(len(points)))
-    current_idx = None
-    current_coords = np.array(start_coords)
+    unvisited = set(range(1, len(points) + 1))
+    current_idx = 0
     route_order = []
     
     while unvisited:
-        if current_idx is not None:
-            unvisited.remove(current_idx)
-        
         # Находим ближайшую непосещенную точку
-        min_dist = float('inf')
-        next_idx = None
-        
-        for idx in unvisited:
-            dist = np.linalg.norm(current_coords - point_coords[idx])
-            if dist < min_dist:
-                min_dist = dist
-                next_idx = idx
-        
-        if next_idx is not None:
-            route_order.append(point_addresses[next_idx])
-            current_coords = point_coords[next_idx]
-            current_idx = next_idx
-        else:
-            break
+        next_idx = min(unvisited, key=lambda idx: dist[current_idx, idx])
+        unvisited.remove(next_idx)
+        route_order.append(point_addresses[next_idx - 1])
+        current_idx = next_idx
     
     return route_order
 
+# --- Локальная оценка маршрута ---
+def estimate_route_summary(waypoints: List[Tuple[float, float]],
+                           departure_time: Optional[str] = None,
+                           return_to_base: bool = False) -> Dict:
+    """Оценка длины и времени маршрута без TomTom
+    
+    Расстояние - по прямой с поправкой ROAD_CIRCUITY, скорость на каждом плече
+    берется из SPEED_PROFILE_KMH по часу прибытия с учетом разгрузок. Поля как в
+    summary TomTom, плюс estimated=True.
+    """
+    try:
+        departure_dt = datetime.fromisoformat(departure_time) if departure_time else datetime.now()
+    except ValueError:
+        departure_dt = datetime.now()
+    
+    path = list(waypoints) + ([waypoints[0]] if return_to_base and len(waypoints) > 1 else [])
+    if len(path) < 2:
+        return {'lengthInMeters': 0, 'travelTimeInSeconds': 0, 'estimated': True}
+    
+    path = np.radians(np.asarray(path, dtype=float))
+    lat1, lon1, lat2, lon2 = path[:-1, 0], path[:-1, 1], path[1:, 0], path[1:, 1]
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    legs_km = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0))) * ROAD_CIRCUITY
+    
+    clock = departure_dt
+    travel_seconds = 0.0
+    for leg_km in legs_km:
+        seconds = leg_km / SPEED_PROFILE_KMH[clock.hour % 24] * 3600
+        travel_seconds += seconds
+        clock += timedelta(seconds=seconds + SERVICE_TIME_MINUTES * 60)
+    
+    return {
+        'lengthInMeters': int(legs_km.sum() * 1000),
+        'travelTimeInSeconds': int(travel_seconds),
+        'departureTime': departure_dt.isoformat(),
+        'estimated': True
+    }
+
+def route_summary(info: Dict, departure_time: Optional[str] = None) -> Dict:
+    """Сводка маршрута: данные TomTom, а пока их нет или запрос не удался - локальная оценка"""
+    record = info.get('route')
+    if record is not None and record.summary:
+        return record.summary
+    if not info.get('addresses'):
+        return {}
+    return estimate_route_summary(info.get('waypoints', []), departure_time, info.get('return_to_base', False))
+
+# --- Матрица времени в пути по дорогам (TomTom Matrix Routing) ---
+class TravelMatrixCache:
+    """Кэш времени и расстояния по дорогам для пар координат и интервала отправления"""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS travel_matrix ("
+            "origin TEXT, destination TEXT, bucket TEXT, seconds REAL, meters REAL, created_at REAL, "
+            "PRIMARY KEY (origin, destination, bucket))"
+        )
+        self.conn.commit()
+
+    def load(self, keys: List[str], bucket: str, seconds: np.ndarray, meters: np.ndarray):
+        """Заполнить матрицы известными значениями из кэша"""
+        position = {key: i for i, key in enumerate(keys)}
+        unique_keys = list(position)
+        min_created_at = time.time() - TRAVEL_MATRIX_CACHE_TTL
+        for start in range(0, len(unique_keys), 500):
+            chunk = unique_keys[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT origin, destination, seconds, meters FROM travel_matrix "
+                f"WHERE bucket = ? AND created_at >= ? AND origin IN ({placeholders})",
+                (bucket, min_created_at, *chunk)
+            ).fetchall()
+            for origin, destination, sec, m in rows:
+                if destination in position:
+                    seconds[position[origin], position[destination]] = sec
+                    meters[position[origin], position[destination]] = m
+
+    def save(self, entries: List[Tuple[str, str, str, float, float]]):
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO travel_matrix (origin, destination, bucket, seconds, meters, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(*entry, now) for entry in entries]
+        )
+        self.conn.commit()
+
+travel_matrix_cache = TravelMatrixCache(os.path.join(DATA_DIR, "travel_matrix.db"))
+
+def departure_bucket(departure_time: Optional[str]) -> str:
+    """Интервал отправления для кэша: день недели и время, округленное до TRAVEL_MATRIX_BUCKET_MINUTES"""
+    departure_dt = datetime.fromisoformat(departure_time) if departure_time else datetime.now()
+    minutes = departure_dt.hour * 60 + departure_dt.minute
+    minutes -= minutes % TRAVEL_MATRIX_BUCKET_MINUTES
+    return f"{departure_dt.weekday()}-{minutes // 60:02d}{minutes % 60:02d}"
+
+def _matrix_options(departure_time: Optional[str]) -> Dict:
+    options = {
+        "travelMode": TRUCK_PROFILE["travelMode"],
+        "vehicleMaxSpeed": TRUCK_PROFILE["vehicleMaxSpeed"],
+        "vehicleWeight": TRUCK_PROFILE["vehicleWeight"],
+        "vehicleLength": TRUCK_PROFILE["vehicleLength"],
+        "vehicleWidth": TRUCK_PROFILE["vehicleWidth"],
+        "vehicleHeight": TRUCK_PROFILE["vehicleHeight"],
+        "vehicleCommercial": TRUCK_PROFILE["vehicleCommercial"] == "true",
+        "routeType": "fastest",
+        "traffic": "historical",
+        "avoid": ["unpavedRoads"]
+    }
+    # TomTom не принимает время отправления в прошлом
+    if departure_time and datetime.fromisoformat(departure_time) > datetime.now():
+        options["departAt"] = datetime.fromisoformat(departure_time).isoformat(timespec="seconds")
+    return options
+
+async def _fetch_matrix_tile(origins: np.ndarray, destinations: np.ndarray, options: Dict) -> List[Dict]:
+    body = {
+        "origins": [{"point": {"latitude": lat, "longitude": lon}} for lat, lon in origins],
+        "destinations": [{"point": {"latitude": lat, "longitude": lon}} for lat, lon in destinations],
+        "options": options
+    }
+    await tomtom_limiter.acquire()
+    session = get_http_session()
+    async with session.post(f"{TOMTOM_BASE_URL}/routing/matrix/2", params={"key": TOMTOM_API_KEY},
+                            json=body, timeout=60) as response:
+        response.raise_for_status()
+        return (await response.json()).get("data", [])
+
+async def tomtom_travel_matrix(coords: np.ndarray,
+                               departure_time: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Матрицы времени (с) и расстояния (м) по дорогам для профиля грузовика
+    
+    Известные пары берутся из кэша, недостающие запрашиваются у TomTom Matrix Routing
+    параллельно тайлами не больше TOMTOM_MATRIX_MAX_CELLS ячеек. Для матриц больше
+    TOMTOM_MATRIX_MAX_POINTS точек запросы не делаются: при TOMTOM_RPS это заняло бы
+    минуты. Пары, которые не удалось получить, оцениваются по прямой с коэффициентом
+    ROAD_CIRCUITY.
+    """
+    n = len(coords)
+    keys = [f"{lat:.5f},{lon:.5f}" for lat, lon in coords]
+    bucket = departure_bucket(departure_time)
+    seconds = np.full((n, n), np.nan)
+    meters = np.full((n, n), np.nan)
+    np.fill_diagonal(seconds, 0)
+    np.fill_diagonal(meters, 0)
+    travel_matrix_cache.load(keys, bucket, seconds, meters)
+    
+    # Форма тайла в пределах лимита ячеек, при которой запросов меньше всего
+    rows, cols = min(
+        ((max(1, TOMTOM_MATRIX_MAX_CELLS // c), c) for c in range(1, max(1, min(n, TOMTOM_MATRIX_MAX_CELLS)) + 1)),
+        key=lambda shape: -(-n // shape[0]) * -(-n // shape[1])
+    )
+    tiles = [
+        (oi, di) for oi in range(0, n, rows) for di in range(0, n, cols)
+        if np.isnan(seconds[oi:oi + rows, di:di + cols]).any()
+    ] if n <= TOMTOM_MATRIX_MAX_POINTS else []
+    options = _matrix_options(departure_time)
+    semaphore = asyncio.Semaphore(TOMTOM_MATRIX_CONCURRENCY)
+    fetched = []
+    
+    async def fetch(oi: int, di: int):
+        async with semaphore:
+            try:
+                cells = await _fetch_matrix_tile(coords[oi:oi + rows], coords[di:di + cols], options)
+            except Exception:
+                return
+        for cell in cells:
+            summary = cell.get("routeSummary")
+            if not summary:
+                continue
+            i, j = oi + cell["originIndex"], di + cell["destinationIndex"]
+            seconds[i, j] = summary["travelTimeInSeconds"]
+            meters[i, j] = summary["lengthInMeters"]
+            fetched.append((keys[i], keys[j], bucket, seconds[i, j], meters[i, j]))
+    
+    await asyncio.gather(*(fetch(oi, di) for oi, di in tiles))
+    if fetched:
+        travel_matrix_cache.save(fetched)
+    
+    missing = np.isnan(seconds)
+    if missing.any():
+        road_km = haversine_matrix(coords) * ROAD_CIRCUITY
+        seconds[missing] = (road_km / AVERAGE_SPEED_KMH * 3600)[missing]
+        meters[missing] = (road_km * 1000)[missing]
+    
+    return seconds, meters
+
+async def prepare_distance_matrix(user_id: int) -> Optional[DistanceMatrix]:
+    """Матрица сессии; в режиме ROUTING_MATRIX_MODE=tomtom - с временем в пути по дорогам"""
+    matrix = get_distance_matrix(user_id)
+    if matrix is None or ROUTING_MATRIX_MODE != "tomtom":
+        return matrix
+    
+    bucket = departure_bucket(user_data[user_id].get('departure_time'))
+    if matrix.road_seconds is None or matrix.road_bucket != bucket:
+        matrix.road_seconds, matrix.road_meters = await tomtom_travel_matrix(
+            matrix.coords, user_data[user_id].get('departure_time')
+        )
+        matrix.road_bucket = bucket
+    return matrix
+
+# --- Построение и улучшение порядка объезда ---
+def _nearest_neighbor_tour(dist: np.ndarray) -> np.ndarray:
+    """Жадный тур от индекса 0; в конец добавляется индекс финиша n+1"""
+    n = dist.shape[0] - 1
+    visited = np.zeros(n + 1, dtype=bool)
+    visited[0] = True
+    tour = [0]
+    current = 0
+    for _ in range(n):
+        current = int(np.argmin(np.where(visited, np.inf, dist[current])))
+        visited[current] = True
+        tour.append(current)
+    tour.append(n + 1)
+    return np.array(tour, dtype=int)
+
+def _two_opt_pass(ext: np.ndarray, tour: np.ndarray, deadline: float) -> bool:
+    """Один проход 2-opt (разворот отрезков), для каждой позиции - лучший ход"""
+    n = len(tour) - 2
+    improved = False
+    for i in range(1, n):
+        if time.perf_counter() > deadline:
+            break
+        js = np.arange(i + 1, n + 1)
+        a, b = tour[i - 1], tour[i]
+        c, d = tour[js], tour[js + 1]
+        delta = ext[a, c] + ext[b, d] - ext[a, b] - ext[c, d]
+        k = int(np.argmin(delta))
+        if delta[k] < -1e-9:
+            j = js[k]
+            tour[i:j + 1] = tour[i:j + 1][::-1]
+            improved = True
+    return improved
+
+def _or_opt_pass(ext: np.ndarray, tour: np.ndarray, deadline: float) -> bool:
+    """Один проход Or-opt: перенос цепочек из 1-3 точек (в т.ч. с разворотом)"""
+    n = len(tour) - 2
+    improved = False
+    for seg_len in (1, 2, 3):
+        for i in range(1, n - seg_len + 2):
+            if time.perf_counter() > deadline:
+                return improved
+            seg = tour[i:i + seg_len].copy()
+            p, q = tour[i - 1], tour[i + seg_len]
+            removal_gain = ext[p, seg[0]] + ext[seg[-1], q] - ext[p, q]
+            
+            rest = np.concatenate([tour[:i], tour[i + seg_len:]])
+            x, y = rest[:-1], rest[1:]
+            forward = ext[x, seg[0]] + ext[seg[-1], y] - ext[x, y]
+            backward = ext[x, seg[-1]] + ext[seg[0], y] - ext[x, y]
+            forward[i - 1] = backward[i - 1] = np.inf  # исходное место
+            
+            k_fwd, k_bwd = int(np.argmin(forward)), int(np.argmin(backward))
+            if forward[k_fwd] <= backward[k_bwd]:
+                k, cost, moved = k_fwd, forward[k_fwd], seg
+            else:
+                k, cost, moved = k_bwd, backward[k_bwd], seg[::-1]
+            
+            if cost - removal_gain < -1e-9:
+                tour[:] = np.concatenate([rest[:k + 1], moved, rest[k + 1:]])
+                improved = True
+    return improved
+
+def solve_route_order(start_coords: Tuple[float, float],
+                      points: List[Tuple[str, Tuple[float, float]]],
+                      matrix: Optional[DistanceMatrix] = None,
+                      return_to_base: bool = False,
+                      time_budget: Optional[float] = None) -> List[str]:
+    """Порядок объезда: жадный тур + улучшение 2-opt и Or-opt в пределах time_budget секунд
+    
+    При return_to_base учитывается обратный путь на производство, иначе маршрут
+    заканчивается на последнем адресе.
+    """
+    if not points:
+        return []
+    
+    n = len(points)
+    dist = route_distance_matrix(start_coords, points, matrix)
+    
+    # Индекс n+1 - финиш: производство при возврате, иначе "бесплатная" точка
+    ext = np.zeros((n + 2, n + 2))
+    ext[:n + 1, :n + 1] = dist
+    if return_to_base:
+        ext[:n + 1, n + 1] = dist[:, 0]
+        ext[n + 1, :n + 1] = dist[0, :]
+    
+    tour = _nearest_neighbor_tour(dist)
+    budget = ROUTE_SOLVER_TIME_BUDGET if time_budget is None else time_budget
+    deadline = time.perf_counter() + budget
+    
+    improved = n > 1
+    while improved and time.perf_counter() < deadline:
+        improved = _two_opt_pass(ext, tour, deadline)
+        improved = _or_opt_pass(ext, tour, deadline) or improved
+    
+    return [points[idx - 1][0] for idx in tour[1:-1]]
+
+def cheapest_insertion_position(start_coords: Tuple[float, float],
+                                points: List[Tuple[str, Tuple[float, float]]],
+                                new_point: Tuple[str, Tuple[float, float]],
+                                matrix: Optional[DistanceMatrix] = None,
+                                return_to_base: bool = False) -> int:
+    """Позиция в points, вставка new_point в которую меньше всего удлиняет маршрут"""
+    if not points:
+        return 0
+    n = len(points)
+    dist = route_distance_matrix(start_coords, points + [new_point], matrix)
+    new = n + 1
+    # Вставка между узлами path[j] и path[j+1]; после последней точки - финиш
+    path = np.arange(n + 1)
+    following = np.append(path[1:], 0)
+    added = dist[path, new] + dist[new, following] - dist[path, following]
+    if not return_to_base:
+        added[-1] = dist[n, new]
+    return int(np.argmin(added))
+
+def route_length_km(start_coords: Tuple[float, float],
+                    points: List[Tuple[str, Tuple[float, float]]],
+                    order: List[str],
+                    return_to_base: bool = False) -> float:
+    """Длина маршрута по прямой (км) для заданного порядка адресов"""
+    coords = dict(points)
+    path = [start_coords] + [coords[addr] for addr in order]
+    if return_to_base:
+        path.append(start_coords)
+    path = np.radians(np.asarray(path, dtype=float))
+    lat1, lon1, lat2, lon2 = path[:-1, 0], path[:-1, 1], path[1:, 0], path[1:, 1]
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return float((2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))).sum())
+
+def random_moscow_points(n: int, seed: int = 0) -> List[Tuple[str, Tuple[float, float]]]:
+    """Случайные точки в пределах МКАД для бенчмарков"""
+    rng = np.random.default_rng(seed)
+    lats = rng.uniform(55.57, 55.91, n)
+    lons = rng.uniform(37.37, 37.85, n)
+    return [(f"Адрес {i + 1}", (float(lat), float(lon))) for i, (lat, lon) in enumerate(zip(lats, lons))]
+
+def benchmark_route_solver(n_stops: int = 200, trials: int = 5,
+                           return_to_base: bool = False) -> Dict[str, float]:
+    """Сравнение solve_route_order с optimize_route_nearest_neighbor: средние км и время"""
+    start = (55.8617, 37.4131)
+    totals = {'nn_km': 0.0, 'nn_sec': 0.0, 'solver_km': 0.0, 'solver_sec': 0.0}
+    for trial in range(trials):
+        points = random_moscow_points(n_stops, seed=trial)
+        
+        started = time.perf_counter()
+        order = optimize_route_nearest_neighbor(start, points)
+        totals['nn_sec'] += time.perf_counter() - started
+        totals['nn_km'] += route_length_km(start, points, order, return_to_base)
+        
+        started = time.perf_counter()
+        order = solve_route_order(start, points, return_to_base=return_to_base)
+        totals['solver_sec'] += time.perf_counter() - started
+        totals['solver_km'] += route_length_km(start, points, order, return_to_base)
+    
+    return {key: value / trials for key, value in totals.items()}
+
 # --- Алгоритмы балансировки маршрутов ---
+def capacitated_assignment(cost: np.ndarray) -> np.ndarray:
+    """Назначить n точек k кластерам так, чтобы размеры были floor(n/k) или ceil(n/k)
+    
+    До CLUSTER_EXACT_MAX_POINTS точек задача решается точно (задача о назначениях
+    со слотами кластеров), для больших объемов - жадно по убыванию "сожаления"
+    (разницы между лучшим и вторым по стоимости кластером).
+    """
+    n, k = cost.shape
+    if k == 1:
+        return np.zeros(n, dtype=int)  # сожаления без второго кластера нет
+    base, extra = divmod(n, k)
+    
+    if n <= CLUSTER_EXACT_MAX_POINTS:
+        # base обязательных слотов на кластер и по одному дополнительному;
+        # бонус за обязательные слоты гарантирует, что все они будут заняты
+        bonus = float(cost.max() - cost.min()) + 1.0
+        slot_cluster = np.concatenate([np.repeat(np.arange(k), base), np.arange(k)])
+        slot_cost = cost[:, slot_cluster]
+        slot_cost[:, :k * base] -= bonus
+        rows, cols = linear_sum_assignment(slot_cost)
+        labels = np.empty(n, dtype=int)
+        labels[rows] = slot_cluster[cols]
+        return labels
+    
+    preferences = np.argsort(cost, axis=1)
+    sorted_cost = np.take_along_axis(cost, preferences[:, :2], axis=1)
+    order = np.argsort(sorted_cost[:, 0] - sorted_cost[:, 1])  # наибольшее сожаление первым
+    
+    sizes = np.zeros(k, dtype=int)
+    big_left = extra
+    labels = np.empty(n, dtype=int)
+    for i in order:
+        for c in preferences[i]:
+            if sizes[c] < base or (sizes[c] == base and big_left > 0):
+                sizes[c] += 1
+                if sizes[c] > base:
+                    big_left -= 1
+                labels[i] = c
+                break
+    return labels
+
 def balanced_clustering(coords_dict: Dict[str, Tuple[float, float]], 
                        n_clusters: int,
-                       production_coords: Tuple[float, float]) -> Dict[int, List[str]]:
-    """Сбалансированная кластеризация с учетом географии"""
+                       production_coords: Tuple[float, float],
+                       matrix: Optional[DistanceMatrix] = None) -> Dict[int, List[str]]:
+    """Сбалансированная кластеризация с учетом географии
+    
+    Центры инициализируются KMeans, затем точки многократно перераспределяются
+    с жестким ограничением размеров (отличаются не более чем на 1). При наличии
+    матрицы сессии стоимость считается по ней до медоид кластеров.
+    """
     addresses = list(coords_dict.keys())
-    coords = np.array([coords_dict[addr] for addr in addresses])
     
     if len(addresses) <= n_clusters:
         result = {}
@@ -438,40 +2322,302 @@ def balanced_clustering(coords_dict: Dict[str, Tuple[float, float]],
             result[i] = addresses[i:i+1] if i < len(addresses) else []
         return result
     
-    kmeans = KMeans(n_clusters=n_clusters, n_init=10, random_state=42)
-    labels = kmeans.fit_predict(coords)
+    # KMeans работает в километрах локальной проекции, а не в градусах
+    coords = project_local([coords_dict[addr] for addr in addresses], production_coords)
+    kmeans = KMeans(n_clusters=n_clusters, n_init=3, random_state=42).fit(coords)
+    centers = kmeans.cluster_centers_
     
-    cluster_sizes = np.bincount(labels, minlength=n_clusters)
-    target_size = len(addresses) // n_clusters
-    max_size = target_size + (1 if len(addresses) % n_clusters else 0)
+    point_cost = None
+    if matrix is not None and all(addr in matrix.index for addr in addresses):
+        idx = matrix.indices(addresses)
+        point_cost = matrix.cost[np.ix_(idx, idx)]
+        # Медоиды - ближайшие к центрам KMeans адреса
+        medoids = np.argmin(
+            ((coords[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2), axis=0
+        )
     
-    for _ in range(100):
-        max_cluster = np.argmax(cluster_sizes)
-        min_cluster = np.argmin(cluster_sizes)
+    labels = None
+    for _ in range(CLUSTER_MAX_ITER):
+        if point_cost is not None:
+            cost = point_cost[:, medoids]
+        else:
+            cost = np.sqrt(((coords[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2))
         
-        if cluster_sizes[max_cluster] <= max_size and cluster_sizes[min_cluster] >= target_size:
+        new_labels = capacitated_assignment(cost)
+        if labels is not None and np.array_equal(new_labels, labels):
             break
+        labels = new_labels
         
-        if cluster_sizes[max_cluster] > max_size:
-            max_cluster_points = np.where(labels == max_cluster)[0]
-            max_cluster_coords = coords[max_cluster_points]
-            min_cluster_center = kmeans.cluster_centers_[min_cluster]
-            
-            distances = np.linalg.norm(max_cluster_coords - min_cluster_center, axis=1)
-            idx_to_move = np.argmin(distances)
-            point_idx = max_cluster_points[idx_to_move]
+        for c in range(n_clusters):
+            members = np.flatnonzero(labels == c)
+            if point_cost is not None:
+                medoids[c] = members[np.argmin(point_cost[np.ix_(members, members)].sum(axis=1))]
+            else:
+                centers[c] = coords[members].mean(axis=0)
+    
+    result = {i: [] for i in range(n_clusters)}
+    for addr, label in zip(addresses, labels):
+        result[int(label)].append(addr)
+    
+    return result
+
+# --- Балансировка по длительности смены ---
+def travel_seconds_matrix(matrix: DistanceMatrix) -> np.ndarray:
+    """Оценка времени в пути (с) между точками сессии: по дорогам или по прямой"""
+    if matrix.road_seconds is not None:
+        return matrix.road_seconds
+    return matrix.km * ROAD_CIRCUITY / AVERAGE_SPEED_KMH * 3600
+
+def estimate_route_duration(path: List[int], travel: np.ndarray, speed_factor: float = 1.0) -> float:
+    """Длительность маршрута (с): путь от производства (индекс 0) плюс время на разгрузку"""
+    drive = travel[path[:-1], path[1:]].sum() if len(path) > 1 else 0.0
+    return float(drive) * speed_factor + SERVICE_TIME_MINUTES * 60 * (len(path) - 1)
+
+def balance_by_duration(clusters: Dict[int, List[str]],
+                        matrix: DistanceMatrix,
+                        speed_factors: Optional[Dict[int, float]] = None) -> Dict[int, List[str]]:
+    """Перераспределить адреса так, чтобы выровнять длительность смен
+    
+    Длительность - время в пути плюс SERVICE_TIME_MINUTES на каждую точку. На каждом
+    шаге адрес из самого долгого маршрута переносится на самое дешевое место в
+    другом маршруте, если это уменьшает максимум из двух длительностей. speed_factors
+    поправляют локальные оценки по фактическим данным маршрутизации.
+    """
+    travel = travel_seconds_matrix(matrix)
+    service = SERVICE_TIME_MINUTES * 60
+    factors = {driver_id: (speed_factors or {}).get(driver_id, 1.0) for driver_id in clusters}
+    production = matrix.production_coords
+    
+    # Пути в индексах матрицы, начиная с производства
+    paths = {}
+    for driver_id, addresses in clusters.items():
+        points = [(addr, tuple(matrix.coords[matrix.index[addr]])) for addr in addresses]
+        order = solve_route_order(production, points, matrix, time_budget=0.05)
+        paths[driver_id] = [0] + [matrix.index[addr] for addr in order]
+    durations = {d: estimate_route_duration(path, travel, factors[d]) for d, path in paths.items()}
+    
+    deadline = time.perf_counter() + BALANCE_TIME_BUDGET
+    while time.perf_counter() < deadline and len(paths) > 1:
+        longest = max(durations, key=durations.get)
+        path_l = paths[longest]
+        best = None  # (новый максимум, позиция в longest, маршрут, позиция вставки, новые длительности)
+        
+        for pos in range(1, len(path_l)):
+            stop, prev = path_l[pos], path_l[pos - 1]
+            removal = travel[prev, stop]
+            if pos + 1 < len(path_l):
+                nxt = path_l[pos + 1]
+                removal += travel[stop, nxt] - travel[prev, nxt]
+            new_longest = durations[longest] - removal * factors[longest] - service
             
-            labels[point_idx] = min_cluster
-            cluster_sizes[max_cluster] -= 1
-            cluster_sizes[min_cluster] += 1
+            for target, path_t in paths.items():
+                if target == longest:
+                    continue
+                nodes = np.array(path_t)
+                # Вставка после позиции j; после последней точки - просто продолжение пути
+                insertion = travel[nodes, stop].copy()
+                insertion[:-1] += travel[stop, nodes[1:]] - travel[nodes[:-1], nodes[1:]]
+                j = int(np.argmin(insertion))
+                new_target = durations[target] + insertion[j] * factors[target] + service
+                new_max = max(new_longest, new_target)
+                if best is None or new_max < best[0]:
+                    best = (new_max, pos, target, j, new_longest, new_target)
+        
+        if best is None or best[0] >= durations[longest] - 1:
+            break
+        
+        _, pos, target, j, new_longest, new_target = best
+        stop = path_l.pop(pos)
+        paths[target].insert(j + 1, stop)
+        durations[longest], durations[target] = new_longest, new_target
+    
+    return {d: [matrix.addresses[idx - 1] for idx in path[1:]] for d, path in paths.items()}
+
+def route_duration_seconds(info: Dict) -> Optional[float]:
+    """Фактическая длительность смены по данным TomTom (путь + разгрузка)"""
+    summary = info['route'].summary if info.get('route') else {}
+    if not summary.get('travelTimeInSeconds'):
+        return None
+    return summary['travelTimeInSeconds'] + SERVICE_TIME_MINUTES * 60 * len(info['addresses'])
+
+# --- Алгоритм сбережений Кларка-Райта ---
+def savings_routes(coords_dict: Dict[str, Tuple[float, float]],
+                   n_routes: int,
+                   production_coords: Tuple[float, float],
+                   matrix: Optional[DistanceMatrix] = None,
+                   max_stops: Optional[int] = None,
+                   max_duration_minutes: Optional[float] = None) -> Dict[int, List[str]]:
+    """Построить маршруты сразу от производства алгоритмом сбережений Кларка-Райта
+    
+    Сбережения s(i, j) = c(0, i) + c(0, j) - c(i, j) считаются векторно, для каждой
+    точки берутся SAVINGS_NEIGHBORS лучших пар. Маршруты сливаются по убыванию
+    сбережений, пока не нарушены ограничения по числу точек и длительности и пока
+    маршрутов больше n_routes, так что при n >= n_routes ни один водитель не остается
+    без адресов. Лишние маршруты затем присоединяются к соседним с соблюдением
+    ограничения по точкам; длительность при этом может быть превышена: все адреса
+    должны быть доставлены, поэтому число водителей важнее.
+    """
+    addresses = list(coords_dict.keys())
+    if len(addresses) <= n_routes:
+        return {i: addresses[i:i+1] for i in range(n_routes)}
+    
+    if matrix is None or not all(addr in matrix.index for addr in addresses):
+        matrix = DistanceMatrix(production_coords, coords_dict)
+    idx = np.concatenate([[0], matrix.indices(addresses)])
+    cost = matrix.cost[np.ix_(idx, idx)]
+    cost = (cost + cost.T) / 2
+    travel = travel_seconds_matrix(matrix)[np.ix_(idx, idx)]
+    service = SERVICE_TIME_MINUTES * 60
+    n = len(addresses)
     
-    result = {}
-    for i in range(n_clusters):
-        cluster_addresses = [addresses[j] for j in range(len(addresses)) if labels[j] == i]
-        result[i] = cluster_addresses
+    # Без явного ограничения маршрут не длиннее равной доли адресов
+    stop_cap = -(-n // n_routes)
+    if max_stops:
+        stop_cap = min(stop_cap, max_stops)
+    duration_cap = max_duration_minutes * 60 if max_duration_minutes else None
     
+    # Сбережения только для ближайших соседей каждой точки
+    savings = cost[1:, :1] + cost[:1, 1:] - cost[1:, 1:]
+    np.fill_diagonal(savings, -np.inf)
+    k = min(SAVINGS_NEIGHBORS, n - 1)
+    neighbors = np.argpartition(-savings, k - 1, axis=1)[:, :k]
+    rows = np.repeat(np.arange(n), k)
+    cols = neighbors.ravel()
+    keep = rows < cols
+    pair_rows, pair_cols = rows[keep], cols[keep]
+    pair_savings = savings[pair_rows, pair_cols]
+    positive = pair_savings > 0
+    pair_rows, pair_cols, pair_savings = pair_rows[positive], pair_cols[positive], pair_savings[positive]
+    order = np.argsort(-pair_savings, kind="stable")
+    
+    # Точки нумеруются с 1 как в cost; каждый маршрут - список точек
+    routes = {i: [i] for i in range(1, n + 1)}
+    route_of = list(range(n + 1))
+    
+    def duration(path: List[int]) -> float:
+        nodes = [0] + path
+        return float(travel[nodes[:-1], nodes[1:]].sum()) + service * len(path)
+    
+    def join(a: List[int], b: List[int], i: int, j: int) -> Optional[List[int]]:
+        """Соединить маршруты так, чтобы i и j оказались соседями"""
+        if a[-1] != i:
+            if a[0] != i:
+                return None
+            a = a[::-1]
+        if b[0] != j:
+            if b[-1] != j:
+                return None
+            b = b[::-1]
+        return a + b
+    
+    for p in order:
+        if len(routes) <= n_routes:
+            break  # каждому водителю по маршруту
+        i, j = int(pair_rows[p]) + 1, int(pair_cols[p]) + 1
+        ri, rj = route_of[i], route_of[j]
+        if ri == rj or len(routes[ri]) + len(routes[rj]) > stop_cap:
+            continue
+        merged = join(routes[ri], routes[rj], i, j)
+        if merged is None:
+            continue
+        # Маршрут начинается с более близкого к производству конца
+        if cost[0, merged[-1]] < cost[0, merged[0]]:
+            merged.reverse()
+        if duration_cap is not None and duration(merged) > duration_cap:
+            continue
+        routes[ri] = merged
+        for node in routes.pop(rj):
+            route_of[node] = ri
+    
+    # Слишком много маршрутов - самый короткий присоединяем туда, где прирост стоимости минимален.
+    # Ограничение по точкам сохраняется; если max_stops * n_routes < n, оно недостижимо,
+    # и тогда маршруты не длиннее равной доли адресов
+    fold_cap = max(stop_cap, -(-n // n_routes))
+    
+    def insertion(path: List[int], node: int) -> Tuple[float, int]:
+        """Минимальный прирост стоимости и позиция вставки точки в маршрут"""
+        prev = np.array([0] + path)
+        added = cost[prev, node].copy()
+        added[:-1] += cost[node, path] - cost[prev[:-1], path]
+        best = int(np.argmin(added))
+        return float(added[best]), best
+    
+    while len(routes) > n_routes:
+        smallest = min(routes, key=lambda r: len(routes[r]))
+        path = routes.pop(smallest)
+        keys = [r for r in routes if len(routes[r]) + len(path) <= fold_cap]
+        if not keys:
+            # Целиком маршрут никуда не помещается - раскладываем его точки по одной
+            for node in path:
+                candidates = [(insertion(routes[r], node), r) for r in routes if len(routes[r]) < fold_cap]
+                (_, position), target = min(candidates)
+                routes[target].insert(position, node)
+            continue
+        heads = np.array([routes[r][0] for r in keys])
+        tails = np.array([routes[r][-1] for r in keys])
+        # Продолжить чужой маршрут: tail -> head(path); или начать с path: tail(path) -> head вместо 0 -> head
+        after = cost[tails, path[0]]
+        before = cost[path[-1], heads] - cost[0, heads] + cost[0, path[0]]
+        best = int(np.argmin(np.minimum(after, before)))
+        target = keys[best]
+        if after[best] <= before[best]:
+            routes[target] = routes[target] + path
+        else:
+            routes[target] = path + routes[target]
+    
+    result = {i: [] for i in range(n_routes)}
+    for driver_id, path in enumerate(sorted(routes.values(), key=lambda r: cost[0, r[0]])):
+        result[driver_id] = [addresses[node - 1] for node in path]
     return result
 
+def benchmark_distribution_engines(n_addresses: int = 300, n_drivers: int = 8,
+                                   trials: int = 3) -> Dict[str, float]:
+    """Сравнение savings_routes с balanced_clustering + порядок точек
+    
+    Кластеры упорядочиваются и ближайшим соседом (прежний вариант), и тем же
+    solve_route_order, что и маршруты savings, чтобы сравнивать только распределение.
+    Возвращает средние суммарные км по прямой (без возврата) и время работы.
+    """
+    start = (55.8617, 37.4131)
+    totals = {key: 0.0 for key in ('cluster_nn_km', 'cluster_nn_sec', 'cluster_km', 'cluster_sec',
+                                   'savings_km', 'savings_sec')}
+    for trial in range(trials):
+        points = random_moscow_points(n_addresses, seed=trial)
+        coords_dict = dict(points)
+        
+        started = time.perf_counter()
+        clusters = balanced_clustering(coords_dict, n_drivers, start)
+        clustered_sec = time.perf_counter() - started
+        
+        started = time.perf_counter()
+        orders = [
+            optimize_route_nearest_neighbor(start, [(addr, coords_dict[addr]) for addr in members])
+            for members in clusters.values()
+        ]
+        totals['cluster_nn_sec'] += clustered_sec + time.perf_counter() - started
+        totals['cluster_nn_km'] += sum(route_length_km(start, points, order) for order in orders)
+        
+        started = time.perf_counter()
+        matrix = DistanceMatrix(start, coords_dict)
+        orders = [
+            solve_route_order(start, [(addr, coords_dict[addr]) for addr in members], matrix)
+            for members in clusters.values()
+        ]
+        totals['cluster_sec'] += clustered_sec + time.perf_counter() - started
+        totals['cluster_km'] += sum(route_length_km(start, points, order) for order in orders)
+        
+        started = time.perf_counter()
+        matrix = DistanceMatrix(start, coords_dict)
+        routes = savings_routes(coords_dict, n_drivers, start, matrix)
+        orders = [
+            solve_route_order(start, [(addr, coords_dict[addr]) for addr in members], matrix)
+            for members in routes.values()
+        ]
+        totals['savings_sec'] += time.perf_counter() - started
+        totals['savings_km'] += sum(route_length_km(start, points, order) for order in orders)
+    
+    return {key: value / trials for key, value in totals.items()}
+
 # --- Основное меню ---
 def get_main_keyboard() -> ReplyKeyboardMarkup:
     """Главное меню с кнопками"""
@@ -515,6 +2661,7 @@ async def handle_load_pdf(message: types.Message):
     await message.answer(
         "📁 *Загрузка PDF-файлов*\n\n"
         "Отправьте мне PDF-файлы с накладными.\n"
+        "Можно отправить сразу несколько файлов альбомом или ZIP-архив.\n"
         "После загрузки всех файлов нажмите кнопку '🚚 Распределить адреса'.",
         reply_markup=get_main_keyboard(),
         parse_mode="Markdown"
@@ -522,7 +2669,8 @@ async def handle_load_pdf(message: types.Message):
 
 @dp.message(F.document)
 async def handle_docs(message: types.Message):
-    if not message.document.file_name.lower().endswith('.pdf'): 
+    file_name = (message.document.file_name or "").lower()
+    if not file_name.endswith(('.pdf', '.zip')):
         return
     
     user_id = message.from_user.id
@@ -538,41 +2686,65 @@ async def handle_docs(message: types.Message):
             'need_return_config': False
         }
     
+    if file_name.endswith('.zip'):
+        await handle_zip(message, user_id)
+        return
+    
+    if message.media_group_id:
+        collect_album_document(message, user_id)
+        return
+    
     processing_msg = await message.answer("📄 *Обработка документа...*", parse_mode="Markdown")
     
-    uid = str(uuid.uuid4())
-    temp_fn = f"temp_{uid}.pdf"
     try:
-        file = await bot.get_file(message.document.file_id)
-        await bot.download_file(file.file_path, temp_fn)
-        with pdfplumber.open(temp_fn) as pdf:
-            text = "".join([p.extract_text() or "" for p in pdf.pages])
-            addr = clean_address(text)
-            
-            await processing_msg.delete()
-            
-            if addr:
+        found_addresses = await parse_document_cached(
+            lambda: downloaded_document(message.document),
+            message.document.file_unique_id
+        )
+        
+        await processing_msg.delete()
+        
+        if found_addresses:
+            for addr in found_addresses:
                 if addr not in user_data[user_id]['addresses']:
                     user_data[user_id]['addresses'].append(addr)
-                
-                user_data[user_id]['processed_files'] += 1
-                
-                total_addresses = len(user_data[user_id]['addresses'])
-                total_files = user_data[user_id]['processed_files']
-                
-                await message.answer(
-                    f"✅ *Файл обработан:* {message.document.file_name}\n"
-                    f"📍 *Адрес:* {addr}\n\n"
-                    f"📊 *Статистика:*\n"
-                    f"• Обработано файлов: {total_files}\n"
-                    f"• Уникальных адресов: {total_addresses}\n\n"
-                    f"📎 Отправьте следующий файл или нажмите '🚚 Распределить адреса'",
-                    reply_markup=get_main_keyboard(),
-                    parse_mode="Markdown"
-                )
+            
+            user_data[user_id]['processed_files'] += 1
+            
+            total_addresses = len(user_data[user_id]['addresses'])
+            total_files = user_data[user_id]['processed_files']
+            
+            if len(found_addresses) == 1:
+                addresses_text = f"📍 *Адрес:* {found_addresses[0]}\n\n"
             else:
-                await message.answer(f"❌ Ошибка распознавания адреса в {message.document.file_name}",
-                                   reply_markup=get_main_keyboard())
+                # Ограничиваем список, чтобы не превысить длину сообщения Telegram
+                addresses_text = f"📍 *Адресов в файле:* {len(found_addresses)}\n" + "".join(
+                    f"• {addr}\n" for addr in found_addresses[:30]
+                )
+                if len(found_addresses) > 30:
+                    addresses_text += f"• … и еще {len(found_addresses) - 30}\n"
+                addresses_text += "\n"
+            
+            await message.answer(
+                f"✅ *Файл обработан:* {message.document.file_name}\n"
+                f"{addresses_text}"
+                f"📊 *Статистика:*\n"
+                f"• Обработано файлов: {total_files}\n"
+                f"• Уникальных адресов: {total_addresses}\n\n"
+                f"📎 Отправьте следующий файл или нажмите '🚚 Распределить адреса'",
+                reply_markup=get_main_keyboard(),
+                parse_mode="Markdown"
+            )
+        else:
+            await message.answer(f"❌ Ошибка распознавания адреса в {message.document.file_name}",
+                               reply_markup=get_main_keyboard())
+    except asyncio.TimeoutError:
+        try:
+            await processing_msg.delete()
+        except:
+            pass
+        await message.answer(f"❌ Превышено время обработки файла {message.document.file_name}",
+                           reply_markup=get_main_keyboard())
     except Exception as e:
         try:
             await processing_msg.delete()
@@ -580,9 +2752,151 @@ async def handle_docs(message: types.Message):
             pass
         await message.answer(f"❌ Ошибка обработки файла: {str(e)}",
                            reply_markup=get_main_keyboard())
+
+# --- Пакетная загрузка: ZIP-архивы и альбомы документов ---
+# Документы альбома приходят отдельными апдейтами с общим media_group_id
+album_buffers: Dict[str, List[types.Message]] = {}
+
+def collect_album_document(message: types.Message, user_id: int):
+    """Накопить документ альбома; обработка стартует после паузы в поступлении"""
+    group_id = message.media_group_id
+    if group_id not in album_buffers:
+        album_buffers[group_id] = []
+        run_in_background(flush_album(group_id, user_id))
+    album_buffers[group_id].append(message)
+
+async def flush_album(group_id: str, user_id: int):
+    # Альбом обрабатывается вне апдейта, middleware его не видит: сессию закрепляем
+    # сами, иначе ее вытеснят посреди разбора и адреса запишутся в потерянный словарь
+    user_data.pin(user_id)
+    try:
+        # Ждем, пока Telegram перестанет присылать части альбома
+        size = -1
+        while size != len(album_buffers[group_id]):
+            size = len(album_buffers[group_id])
+            await asyncio.sleep(ALBUM_COLLECT_DELAY)
+        
+        messages = album_buffers.pop(group_id)
+        items = [
+            (m.document.file_name, lambda m=m: downloaded_document(m.document), m.document.file_unique_id)
+            for m in messages
+        ]
+        await process_document_batch(messages[0], user_id, items)
     finally:
-        if os.path.exists(temp_fn): 
-            os.remove(temp_fn)
+        user_data.unpin(user_id)
+        save_sessions()
+
+def _zip_entry_name(info: zipfile.ZipInfo) -> str:
+    # Архивы из Windows хранят кириллические имена в cp866 без флага UTF-8
+    if info.flag_bits & 0x800:
+        return info.filename
+    try:
+        return info.filename.encode('cp437').decode('cp866')
+    except UnicodeError:
+        return info.filename
+
+async def handle_zip(message: types.Message, user_id: int):
+    """Разобрать все PDF из ZIP-архива одной пакетной обработкой"""
+    try:
+        async with downloaded_document(message.document) as source:
+            archive_source = io.BytesIO(source) if isinstance(source, bytes) else source
+            with zipfile.ZipFile(archive_source) as archive:
+                entries = [
+                    info for info in archive.infolist()
+                    if not info.is_dir() and info.filename.lower().endswith('.pdf')
+                ]
+                if not entries:
+                    await message.answer("❌ В архиве нет PDF-файлов", reply_markup=get_main_keyboard())
+                    return
+                if len(entries) > ZIP_MAX_FILES:
+                    await message.answer(f"❌ В архиве больше {ZIP_MAX_FILES} PDF-файлов",
+                                       reply_markup=get_main_keyboard())
+                    return
+                
+                @asynccontextmanager
+                async def read_entry(info: zipfile.ZipInfo):
+                    # Проверяем размер до распаковки (защита от zip-бомб)
+                    if info.file_size > PDF_MAX_SIZE:
+                        raise DocumentTooLarge(f"файл больше {PDF_MAX_SIZE // (1024 * 1024)} МБ")
+                    # Распаковка блокирует цикл событий - выполняем в потоке
+                    yield await asyncio.get_running_loop().run_in_executor(None, archive.read, info)
+                
+                items = [
+                    (_zip_entry_name(info), lambda info=info: read_entry(info), None)
+                    for info in entries
+                ]
+                await process_document_batch(message, user_id, items)
+    except zipfile.BadZipFile:
+        await message.answer(f"❌ Файл {message.document.file_name} не является ZIP-архивом",
+                           reply_markup=get_main_keyboard())
+    except Exception as e:
+        await message.answer(f"❌ Ошибка обработки архива: {str(e)}",
+                           reply_markup=get_main_keyboard())
+
+async def process_document_batch(message: types.Message, user_id: int,
+                                 items: List[Tuple[str, DocumentLoader, Optional[str]]]):
+    """Параллельно разобрать набор PDF с одним сообщением о прогрессе и итоговой сводкой"""
+    progress_msg = await message.answer(f"📦 *Обработка файлов:* 0 из {len(items)}", parse_mode="Markdown")
+    semaphore = asyncio.Semaphore(PDF_WORKERS * 2)
+    
+    async def parse_one(name: str, loader: DocumentLoader, file_unique_id: Optional[str]):
+        async with semaphore:
+            try:
+                return name, await parse_document_cached(loader, file_unique_id), None
+            except asyncio.TimeoutError:
+                return name, [], "превышено время обработки"
+            except Exception as e:
+                return name, [], str(e) or type(e).__name__
+    
+    session = user_data[user_id]
+    recognized = []
+    failures = []
+    last_progress_update = time.monotonic()
+    
+    tasks = [asyncio.create_task(parse_one(*item)) for item in items]
+    for done, future in enumerate(asyncio.as_completed(tasks), 1):
+        name, found_addresses, error = await future
+        if found_addresses:
+            session['processed_files'] += 1
+            for addr in found_addresses:
+                if addr not in session['addresses']:
+                    session['addresses'].append(addr)
+                if addr not in recognized:
+                    recognized.append(addr)
+        else:
+            failures.append((name, error or "адрес не распознан"))
+        
+        if done < len(tasks) and time.monotonic() - last_progress_update >= 1:
+            last_progress_update = time.monotonic()
+            try:
+                await progress_msg.edit_text(f"📦 *Обработка файлов:* {done} из {len(tasks)}", parse_mode="Markdown")
+            except Exception:
+                pass
+    
+    try:
+        await progress_msg.delete()
+    except Exception:
+        pass
+    
+    summary = (
+        f"📦 *Пакетная обработка завершена*\n"
+        f"• Файлов: {len(items)}\n"
+        f"• Успешно: {len(items) - len(failures)}\n"
+        f"• Уникальных адресов всего: {len(session['addresses'])}\n"
+    )
+    if recognized:
+        summary += f"\n📍 *Распознанные адреса ({len(recognized)}):*\n"
+        summary += "".join(f"• {addr}\n" for addr in recognized[:30])
+        if len(recognized) > 30:
+            summary += f"• … и еще {len(recognized) - 30}\n"
+    if failures:
+        summary += f"\n❌ *Ошибки ({len(failures)}):*\n"
+        summary += "".join(f"• {name}: {error}\n" for name, error in failures[:30])
+        if len(failures) > 30:
+            summary += f"• … и еще {len(failures) - 30}\n"
+    summary += "\n📎 Отправьте следующие файлы или нажмите '🚚 Распределить адреса'"
+    
+    await message.answer(summary, reply_markup=get_main_keyboard(), parse_mode="Markdown")
 
 @dp.message(F.text == "🚚 Распределить адреса")
 async def handle_distribute(message: types.Message, state: FSMContext):
@@ -598,7 +2912,7 @@ async def handle_distribute(message: types.Message, state: FSMContext):
         f"📊 *Готово к распределению!*\n"
         f"• Всего адресов: {len(addresses)}\n"
         f"• Адрес производства: {PRODUCTION_ADDRESS}\n\n"
-        f"🚚 *Введите количество водителей (1-10):*",
+        f"🚚 *Введите количество водителей (1-{MAX_DRIVERS}):*",
         parse_mode="Markdown"
     )
     await state.set_state(DistributionStates.waiting_for_drivers)
@@ -607,8 +2921,8 @@ async def handle_distribute(message: types.Message, state: FSMContext):
 async def process_drivers_count(message: types.Message, state: FSMContext):
     try:
         num_drivers = int(message.text)
-        if num_drivers < 1 or num_drivers > 10:
-            await message.answer("❌ Введите число от 1 до 10")
+        if num_drivers < 1 or num_drivers > MAX_DRIVERS:
+            await message.answer(f"❌ Введите число от 1 до {MAX_DRIVERS}")
             return
         
         user_id = message.from_user.id
@@ -616,28 +2930,52 @@ async def process_drivers_count(message: types.Message, state: FSMContext):
         
         keyboard = ReplyKeyboardMarkup(
             keyboard=[
-                [KeyboardButton(text="⏱ Сейчас")],
-                [KeyboardButton(text="🕗 08:00")],
-                [KeyboardButton(text="🕘 09:00")],
-                [KeyboardButton(text="🕙 10:00")],
-                [KeyboardButton(text="✏️ Ввести вручную")]
+                [KeyboardButton(text="🧩 По районам")],
+                [KeyboardButton(text="🔗 Сразу маршрутами")]
             ],
             resize_keyboard=True
         )
         
         await message.answer(
-            "⏰ *Выберите время отправления водителей:*\n\n"
-            "• ⏱ Сейчас - текущее время\n"
-            "• Или выберите из предложенных\n"
-            "• Или введите время в формате ЧЧ:ММ (например, 08:30)",
+            "🧭 *Выберите способ распределения:*\n\n"
+            "• 🧩 *По районам* - адреса делятся на равные группы, затем строится порядок\n"
+            "• 🔗 *Сразу маршрутами* - маршруты собираются цепочками от производства (Кларк-Райт), "
+            "районы водителей могут пересекаться; на больших заказах обычно длиннее",
             reply_markup=keyboard,
             parse_mode="Markdown"
         )
-        await state.set_state(DistributionStates.waiting_for_departure_time)
+        await state.set_state(DistributionStates.choosing_engine)
         
     except ValueError:
         await message.answer("❌ Введите корректное число")
 
+@dp.message(DistributionStates.choosing_engine)
+async def process_engine_choice(message: types.Message, state: FSMContext):
+    user_id = message.from_user.id
+    engines = {"🧩 По районам": "cluster", "🔗 Сразу маршрутами": "savings"}
+    user_data[user_id]['engine'] = engines.get(message.text, DISTRIBUTION_ENGINE)
+    
+    keyboard = ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text="⏱ Сейчас")],
+            [KeyboardButton(text="🕗 08:00")],
+            [KeyboardButton(text="🕘 09:00")],
+            [KeyboardButton(text="🕙 10:00")],
+            [KeyboardButton(text="✏️ Ввести вручную")]
+        ],
+        resize_keyboard=True
+    )
+    
+    await message.answer(
+        "⏰ *Выберите время отправления водителей:*\n\n"
+        "• ⏱ Сейчас - текущее время\n"
+        "• Или выберите из предложенных\n"
+        "• Или введите время в формате ЧЧ:ММ (например, 08:30)",
+        reply_markup=keyboard,
+        parse_mode="Markdown"
+    )
+    await state.set_state(DistributionStates.waiting_for_departure_time)
+
 @dp.message(DistributionStates.waiting_for_departure_time)
 async def process_departure_time(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
@@ -688,14 +3026,119 @@ async def process_departure_time(message: types.Message, state: FSMContext):
 async def process_return_setup(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     
-    if message.text == "✅ Да, настроить возврат":
-        user_data[user_id]['need_return_config'] = True
-        await message.answer("✅ Возврат на базу будет настроен после распределения адресов.")
-    else:
-        user_data[user_id]['need_return_config'] = False
-        await message.answer("❌ Возврат на базу не настроен. Все водители завершают маршрут на последнем адресе.")
+    if message.text == "✅ Да, настроить возврат":
+        user_data[user_id]['need_return_config'] = True
+        await message.answer("✅ Возврат на базу будет настроен после распределения адресов.")
+    else:
+        user_data[user_id]['need_return_config'] = False
+        await message.answer("❌ Возврат на базу не настроен. Все водители завершают маршрут на последнем адресе.")
+    
+    await process_distribution(message, state)
+
+def plan_route(production_coords: Tuple[float, float],
+               driver_addresses: List[str],
+               coords_dict: Dict[str, Tuple[float, float]],
+               distance_matrix: Optional[DistanceMatrix],
+               return_to_base: bool = False) -> Dict:
+    """Упорядочить адреса водителя; маршрут TomTom запрашивается отдельно в calculate_routes"""
+    if not driver_addresses:
+        return {
+            'addresses': [],
+            'original_addresses': [],
+            'route': None,
+            'waypoints': [production_coords],
+            'return_to_base': return_to_base
+        }
+    
+    # Формируем список точек для маршрута
+    points = [(addr, coords_dict[addr]) for addr in driver_addresses if addr in coords_dict]
+    
+    # Оптимизируем порядок адресов
+    optimized_order = solve_route_order(production_coords, points, distance_matrix,
+                                        return_to_base=return_to_base)
+    
+    # Формируем waypoints в оптимальном порядке
+    waypoints = [production_coords]
+    for addr in optimized_order:
+        if addr in coords_dict:
+            waypoints.append(coords_dict[addr])
+    
+    return {
+        'addresses': optimized_order,  # Сохраняем оптимизированный порядок
+        'original_addresses': driver_addresses,
+        'route': None,
+        'waypoints': waypoints,
+        'return_to_base': return_to_base
+    }
+
+async def confirm_duration_balance(routes_info: Dict[int, Dict],
+                                   production_coords: Tuple[float, float],
+                                   coords_dict: Dict[str, Tuple[float, float]],
+                                   departure_time: Optional[str],
+                                   distance_matrix: DistanceMatrix) -> Dict[int, Dict]:
+    """Проверить баланс смен по ответам TomTom и при перекосе перераспределить еще раз"""
+    durations = {d: route_duration_seconds(info) for d, info in routes_info.items() if info['addresses']}
+    if len(durations) < 2 or None in durations.values():
+        return routes_info
+    if max(durations.values()) - min(durations.values()) <= DURATION_BALANCE_TOLERANCE * max(durations.values()):
+        return routes_info
+    
+    # Поправочные коэффициенты: во сколько раз реальная дорога дольше локальной оценки
+    travel = travel_seconds_matrix(distance_matrix)
+    speed_factors = {}
+    for driver_id, info in routes_info.items():
+        if info['addresses']:
+            path = [0] + list(distance_matrix.indices(info['addresses']))
+            estimated_drive = estimate_route_duration(path, travel) - SERVICE_TIME_MINUTES * 60 * len(info['addresses'])
+            actual_drive = durations[driver_id] - SERVICE_TIME_MINUTES * 60 * len(info['addresses'])
+            if estimated_drive > 0:
+                speed_factors[driver_id] = actual_drive / estimated_drive
     
-    await process_distribution(message, state)
+    clusters = balance_by_duration(
+        {d: info['addresses'] for d, info in routes_info.items()}, distance_matrix, speed_factors
+    )
+    changed = [
+        driver_id for driver_id, driver_addresses in clusters.items()
+        if set(driver_addresses) != set(routes_info[driver_id]['addresses'])
+    ]
+    for driver_id in changed:
+        routes_info[driver_id] = plan_route(production_coords, clusters[driver_id], coords_dict, distance_matrix)
+    await calculate_routes(routes_info, changed, departure_time)
+    return routes_info
+
+# Фоновые задачи держим в наборе, чтобы их не собрал сборщик мусора
+background_tasks: Set[asyncio.Task] = set()
+
+def run_in_background(coro: Awaitable) -> asyncio.Task:
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def notify_routes_refined(message: types.Message, user_id: int, routing: asyncio.Task,
+                                rebalance: Optional[Callable[[], Awaitable[bool]]] = None):
+    """Сообщить, что TomTom досчитал маршруты и оценки заменены точными данными"""
+    try:
+        await routing
+        # Проверка баланса смен нуждается во времени TomTom, поэтому выполняется только здесь
+        rebalanced = await rebalance() if rebalance is not None else False
+        # Фоновая задача может не обращаться к user_data, и тогда flush сессию не увидит: пишем явно
+        try:
+            user_data.save(user_id)
+        except Exception:
+            pass
+    finally:
+        user_data.unpin(user_id)
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📊 Показать маршруты", callback_data="show_routes_again")]
+    ])
+    text = "✅ TomTom рассчитал маршруты: время и расстояние уточнены."
+    if rebalanced:
+        text += "\n⚖️ Смены оказались неравными, адреса перераспределены по времени."
+    try:
+        await message.answer(text, reply_markup=keyboard)
+    except Exception:
+        pass
 
 async def process_distribution(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
@@ -716,7 +3159,20 @@ async def process_distribution(message: types.Message, state: FSMContext):
     addresses = list(set(user_data[user_id]['addresses']))
     await progress_msg.edit_text(f"📍 *Геокодирование {len(addresses)} адресов доставки...*\n⏳ Это может занять время")
     
-    coords_dict, failed_addresses = await batch_geocode(addresses)
+    last_progress_update = time.monotonic()
+    
+    async def report_geocode_progress(address, coords, done, total):
+        nonlocal last_progress_update
+        # Не чаще раза в секунду, чтобы не упереться в лимиты Telegram
+        if done < total and time.monotonic() - last_progress_update < 1:
+            return
+        last_progress_update = time.monotonic()
+        try:
+            await progress_msg.edit_text(f"📍 *Геокодирование адресов доставки:* {done} из {total}")
+        except Exception:
+            pass
+    
+    coords_dict, failed_addresses = await batch_geocode(addresses, on_result=report_geocode_progress)
     
     if failed_addresses:
         failed_text = "\n".join([f"• {addr.replace('Москва, ', '')}" for addr in failed_addresses])
@@ -739,7 +3195,16 @@ async def process_distribution(message: types.Message, state: FSMContext):
     await progress_msg.edit_text("🔄 *Распределение адресов между водителями...*")
     
     num_drivers = user_data[user_id]['num_drivers']
-    clusters = balanced_clustering(coords_dict, num_drivers, production_coords)
+    distance_matrix = await prepare_distance_matrix(user_id)
+    engine = user_data[user_id].get('engine', DISTRIBUTION_ENGINE)
+    if engine == "savings" and distance_matrix is not None:
+        clusters = savings_routes(
+            coords_dict, num_drivers, production_coords, distance_matrix,
+            max_stops=ROUTE_MAX_STOPS or None,
+            max_duration_minutes=ROUTE_MAX_DURATION_MINUTES or None
+        )
+    else:
+        clusters = balanced_clustering(coords_dict, num_drivers, production_coords, distance_matrix)
     
     # Расчет маршрутов с оптимизацией порядка
     await progress_msg.edit_text("🔄 *Расчет оптимальных маршрутов...*\n⏳ Учитываю трафик, время и оптимизирую порядок")
@@ -747,42 +3212,52 @@ async def process_distribution(message: types.Message, state: FSMContext):
     routes_info = {}
     departure_time = user_data[user_id]['departure_time']
     
+    if BALANCE_MODE == "duration" and distance_matrix is not None:
+        clusters = balance_by_duration(clusters, distance_matrix)
+    
     for driver_id, driver_addresses in clusters.items():
-        if driver_addresses:
-            # Формируем список точек для маршрута
-            points = [(addr, coords_dict[addr]) for addr in driver_addresses if addr in coords_dict]
-            
-            # Оптимизируем порядок адресов
-            optimized_order = optimize_route_nearest_neighbor(production_coords, points)
-            
-            # Формируем waypoints в оптимальном порядке
-            waypoints = [production_coords]
-            for addr in optimized_order:
-                if addr in coords_dict:
-                    waypoints.append(coords_dict[addr])
-            
-            # Рассчитываем маршрут через TomTom
-            route_data = await tomtom_calculate_optimized_route(
-                waypoints, 
-                departure_time,
-                return_to_start=False
-            )
-            
-            routes_info[driver_id] = {
-                'addresses': optimized_order,  # Сохраняем оптимизированный порядок
-                'original_addresses': driver_addresses,
-                'route_data': route_data,
-                'waypoints': waypoints,
-                'return_to_base': False
-            }
-        else:
-            routes_info[driver_id] = {
-                'addresses': [],
-                'original_addresses': [],
-                'route_data': {},
-                'waypoints': [production_coords],
-                'return_to_base': False
-            }
+        routes_info[driver_id] = plan_route(production_coords, driver_addresses, coords_dict, distance_matrix)
+    
+    last_progress_update = time.monotonic()
+    
+    async def report_route_progress(driver_id, info, done, total):
+        nonlocal last_progress_update
+        if done < total and time.monotonic() - last_progress_update < 1:
+            return
+        last_progress_update = time.monotonic()
+        try:
+            await progress_msg.edit_text(f"🔄 *Расчет маршрутов:* {done} из {total}")
+        except Exception:
+            pass
+    
+    routing = asyncio.create_task(
+        calculate_routes(routes_info, routes_info, departure_time, on_result=report_route_progress)
+    )
+    rebalance = None
+    if BALANCE_MODE == "duration" and distance_matrix is not None:
+        planned = {d: list(info['addresses']) for d, info in routes_info.items()}
+        
+        async def rebalance_routes() -> bool:
+            # Пока TomTom считал, маршруты могли отредактировать или построить заново
+            if user_id not in user_data or user_data[user_id].get('routes_info') is not routes_info:
+                return False
+            if {d: info['addresses'] for d, info in routes_info.items()} != planned:
+                return False
+            await confirm_duration_balance(routes_info, production_coords, coords_dict, departure_time, distance_matrix)
+            return {d: info['addresses'] for d, info in routes_info.items()} != planned
+        
+        rebalance = rebalance_routes
+    
+    # Медленный TomTom не задерживает результат: показываем оценки, маршруты досчитываются в фоне
+    done, _ = await asyncio.wait({routing}, timeout=ROUTE_WAIT_SECONDS)
+    if not done:
+        # Пока маршруты досчитываются, сессию нельзя вытеснять: результаты запишутся в ее routes_info
+        user_data.pin(user_id)
+        run_in_background(notify_routes_refined(message, user_id, routing, rebalance))
+    elif rebalance is not None:
+        routes_info = await confirm_duration_balance(
+            routes_info, production_coords, coords_dict, departure_time, distance_matrix
+        )
     
     user_data[user_id]['routes_info'] = routes_info
     
@@ -801,24 +3276,36 @@ async def process_distribution(message: types.Message, state: FSMContext):
 async def show_routes(message: types.Message, user_id: int):
     """Показать построенные маршруты"""
     routes_info = user_data[user_id]['routes_info']
+    departure_time = user_data[user_id].get('departure_time')
     
     for driver_id, info in sorted(routes_info.items()):
-        route_data = info.get('route_data', {})
         addresses = info['addresses']
         
-        summary = route_data.get('routes', [{}])[0].get('summary', {})
+        summary = route_summary(info, departure_time)
         total_time = summary.get('travelTimeInSeconds', 0)
         total_distance = summary.get('lengthInMeters', 0)
+        # Оценочные значения помечаются "~" и пояснением
+        mark, note = ("~", " (оценка)") if summary.get('estimated') else ("", "")
         
         route_text = f"🚛 *МАРШРУТ {driver_id+1}*\n"
         
         if total_time > 0:
-            route_text += f"⏱ Время: {total_time // 60} мин\n"
+            route_text += f"⏱ Время: {mark}{total_time // 60} мин{note}\n"
         if total_distance > 0:
-            route_text += f"📏 Расстояние: {total_distance / 1000:.1f} км\n"
+            route_text += f"📏 Расстояние: {mark}{total_distance / 1000:.1f} км{note}\n"
         
         route_text += f"📍 Адресов: {len(addresses)}\n"
         
+        if info.get('route_status') == "pending":
+            route_text += "⏳ Маршрут пересчитывается\n"
+        if info.get('route_status') == "failed":
+            error = re.sub(r'[_*`\[\]]', '', info.get('route_error') or "")
+            route_text += f"⚠️ Маршрут TomTom не рассчитан: {error}\n"
+        
+        if BALANCE_MODE == "duration" and total_time > 0:
+            shift_minutes = (total_time + SERVICE_TIME_MINUTES * 60 * len(addresses)) // 60
+            route_text += f"🕐 Смена с разгрузкой: {mark}{shift_minutes:.0f} мин{note}\n"
+        
         if info.get('return_to_base'):
             route_text += f"🔄 Возврат на базу: ✅\n"
         
@@ -839,10 +3326,13 @@ async def show_distribution_stats(message: types.Message, user_id: int):
     routes_info = user_data[user_id]['routes_info']
     all_addresses = user_data[user_id]['addresses']
     
+    departure_time = user_data[user_id].get('departure_time')
+    
     stats_text = "📊 *Статистика распределения:*\n\n"
     total_distributed = 0
     total_time = 0
     total_distance = 0
+    any_estimated = False
     
     for driver_id, info in sorted(routes_info.items()):
         addresses = info['addresses']
@@ -851,21 +3341,24 @@ async def show_distribution_stats(message: types.Message, user_id: int):
         stats_text += f"🚛 *Маршрут {driver_id+1}:*\n"
         stats_text += f"   📍 Адресов: {len(addresses)}\n"
         
-        route_data = info.get('route_data', {})
-        if route_data:
-            summary = route_data.get('routes', [{}])[0].get('summary', {})
+        summary = route_summary(info, departure_time)
+        if summary:
             travel_time = summary.get('travelTimeInSeconds', 0) // 60
             distance = summary.get('lengthInMeters', 0) / 1000
             total_time += travel_time
             total_distance += distance
+            mark = "~" if summary.get('estimated') else ""
+            any_estimated = any_estimated or bool(mark)
             
             if travel_time > 0:
-                stats_text += f"   ⏱ Время: {travel_time} мин\n"
+                stats_text += f"   ⏱ Время: {mark}{travel_time} мин\n"
             if distance > 0:
-                stats_text += f"   📏 Расстояние: {distance:.1f} км\n"
+                stats_text += f"   📏 Расстояние: {mark}{distance:.1f} км\n"
         
         if info.get('return_to_base'):
             stats_text += f"   🔄 Возврат на базу: ✅\n"
+        if info.get('route_status') == "failed":
+            stats_text += "   ⚠️ Маршрут не рассчитан\n"
         
         stats_text += "\n"
     
@@ -874,12 +3367,15 @@ async def show_distribution_stats(message: types.Message, user_id: int):
     stats_text += f"   📍 Распределено: {total_distributed}\n"
     stats_text += f"   📍 Не распределено: {len(all_addresses) - total_distributed}\n"
     
+    mark = "~" if any_estimated else ""
     if total_time > 0:
-        stats_text += f"   ⏱ Общее время: {total_time} мин\n"
+        stats_text += f"   ⏱ Общее время: {mark}{total_time} мин\n"
     if total_distance > 0:
-        stats_text += f"   📏 Общее расстояние: {total_distance:.1f} км\n"
+        stats_text += f"   📏 Общее расстояние: {mark}{total_distance:.1f} км\n"
     
     stats_text += f"   🚛 Водителей: {len(routes_info)}"
+    if any_estimated:
+        stats_text += "\n\n~ - оценка без TomTom, уточнится после ответа сервиса"
     
     await message.answer(stats_text, parse_mode="Markdown", reply_markup=get_main_keyboard())
 
@@ -949,21 +3445,18 @@ async def finish_return_setup_handler(callback: CallbackQuery):
     
     await callback.message.edit_text("🔄 Пересчитываю маршруты с учетом возврата на базу...")
     
-    for driver_id, info in routes_info.items():
-        if info.get('return_to_base') and info['addresses']:
-            waypoints = [production_coords]
-            for addr in info['addresses']:
-                if addr in address_coords:
-                    waypoints.append(address_coords[addr])
-            
-            route_data = await tomtom_calculate_optimized_route(
-                waypoints, 
-                departure_time,
-                return_to_start=True
-            )
-            
-            info['route_data'] = route_data
-            info['waypoints'] = waypoints
+    distance_matrix = get_distance_matrix(user_id)
+    
+    # С возвратом на базу оптимальный порядок объезда может измениться
+    returning = [d for d, info in routes_info.items() if info.get('return_to_base') and info['addresses']]
+    for driver_id in returning:
+        info = routes_info[driver_id]
+        routes_info[driver_id] = plan_route(
+            production_coords, info['addresses'], address_coords, distance_matrix,
+            return_to_base=True
+        )
+        routes_info[driver_id]['original_addresses'] = info['original_addresses']
+    await calculate_routes(routes_info, returning, departure_time)
     
     await callback.message.answer("✅ Настройка возврата завершена. Маршруты пересчитаны.")
     await show_routes(callback.message, user_id)
@@ -975,7 +3468,8 @@ async def offer_actions(message: types.Message, user_id: int):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✏️ Редактировать маршруты", callback_data="edit_routes")],
         [InlineKeyboardButton(text="📊 Показать статистику", callback_data="show_stats")],
-        [InlineKeyboardButton(text="📤 Экспорт маршрутов", callback_data="export_routes")]
+        [InlineKeyboardButton(text="📤 Экспорт маршрутов", callback_data="export_routes")],
+        [InlineKeyboardButton(text="🧭 Инструкции для водителя", callback_data="guidance_menu")]
     ])
     
     await message.answer(
@@ -986,32 +3480,233 @@ async def offer_actions(message: types.Message, user_id: int):
     )
 
 # --- Редактирование маршрутов ---
-@dp.callback_query(F.data == "edit_routes")
-async def start_edit_routes(callback: CallbackQuery, state: FSMContext):
-    user_id = callback.from_user.id
+# Два режима (edit_mode в данных FSM, по умолчанию EDIT_MODE):
+# - queue: правки копятся как список операций и применяются одним пересчетом по кнопке
+#   "🏁 Завершить редактирование"; черновик воспроизводится из routes_info и операций;
+# - instant: каждая правка сразу меняет routes_info, порядок остальных адресов сохраняется,
+#   а TomTom в фоне пересчитывает только затронутые маршруты.
+def insert_at_cheapest(user_id: int, route_addresses: List[str], address: str, return_to_base: bool = False):
+    """Вставить адрес в список маршрута на место с наименьшим удлинением"""
+    session = user_data[user_id]
+    address_coords = session['address_coords']
+    points = [(addr, address_coords[addr]) for addr in route_addresses]
+    position = cheapest_insertion_position(
+        session['production_coords'], points, (address, address_coords[address]),
+        get_distance_matrix(user_id), return_to_base=return_to_base
+    )
+    route_addresses.insert(position, address)
+
+def edit_op_applies(draft: Dict[int, List[str]], op: Dict) -> bool:
+    """Применима ли операция к черновику: повторное нажатие кнопки дает устаревшую операцию"""
+    source, target = op.get('source'), op.get('target')
+    if source not in draft or op.get('address') not in draft[source]:
+        return False
+    if op['op'] == "remove":
+        return True
+    if target not in draft or target == source:
+        return False
+    return op['op'] == "move" or (op['op'] == "swap" and op.get('other') in draft[target])
+
+def replay_edit_ops(user_id: int, ops: List[Dict]) -> Tuple[Dict[int, List[str]], List[Dict]]:
+    """Черновик маршрутов после операций move / swap / remove и список примененных операций"""
+    routes_info = user_data[user_id]['routes_info']
+    draft = {driver_id: list(info['addresses']) for driver_id, info in routes_info.items()}
+    returns = {driver_id: info.get('return_to_base', False) for driver_id, info in routes_info.items()}
+    applied = []
     
-    if user_id not in user_data or 'routes_info' not in user_data[user_id]:
-        await callback.answer("Нет данных о маршрутах")
-        return
+    for op in ops:
+        if not edit_op_applies(draft, op):
+            continue
+        if op['op'] == "move":
+            draft[op['source']].remove(op['address'])
+            insert_at_cheapest(user_id, draft[op['target']], op['address'], returns[op['target']])
+        elif op['op'] == "swap":
+            draft[op['source']].remove(op['address'])
+            draft[op['target']].remove(op['other'])
+            insert_at_cheapest(user_id, draft[op['target']], op['address'], returns[op['target']])
+            insert_at_cheapest(user_id, draft[op['source']], op['other'], returns[op['source']])
+        elif op['op'] == "remove":
+            draft[op['source']].remove(op['address'])
+        applied.append(op)
+    return draft, applied
+
+def apply_edit_ops(user_id: int, ops: List[Dict]) -> Dict[int, List[str]]:
+    return replay_edit_ops(user_id, ops)[0]
+
+def refresh_waypoints(info: Dict, production_coords: Tuple[float, float],
+                      address_coords: Dict[str, Tuple[float, float]]):
+    """Обновить waypoints по текущему порядку адресов; старый ответ TomTom становится неактуальным"""
+    info['waypoints'] = [production_coords] + [address_coords[addr] for addr in info['addresses'] if addr in address_coords]
+    info['route'] = None
+    info['route_status'] = "pending" if len(info['waypoints']) > 1 else None
+    info['route_error'] = None
+
+def apply_edit_op_now(user_id: int, op: Dict) -> List[int]:
+    """Применить правку сразу к маршрутам сессии и вернуть маршруты, которые нужно пересчитать"""
+    session = user_data[user_id]
+    routes_info = session['routes_info']
+    draft = apply_edit_ops(user_id, [op])
+    changed = [d for d, addresses in draft.items() if addresses != routes_info[d]['addresses']]
+    for driver_id in changed:
+        routes_info[driver_id]['addresses'] = draft[driver_id]
+        refresh_waypoints(routes_info[driver_id], session['production_coords'], session['address_coords'])
+    return changed
+
+# Фоновые пересчеты маршрутов после правок, по пользователям
+route_update_tasks: Dict[int, Set[asyncio.Task]] = {}
+
+def schedule_route_update(message: types.Message, user_id: int, driver_ids: List[int]):
+    """Запросить маршруты driver_ids в фоне и сообщить итоги, когда ответы придут"""
+    async def update():
+        try:
+            session = user_data[user_id]
+            routes_info = session['routes_info']
+            await calculate_routes(routes_info, driver_ids, session['departure_time'])
+            try:
+                user_data.save(user_id)
+            except Exception:
+                pass
+        finally:
+            user_data.unpin(user_id)
+        
+        lines = []
+        for driver_id in driver_ids:
+            info = routes_info[driver_id]
+            if info.get('route_status') == "pending":
+                continue  # маршрут уже снова изменен, итог придет со следующим пересчетом
+            summary = info['route'].summary if info.get('route') else {}
+            if summary:
+                lines.append(
+                    f"🚛 Маршрут {driver_id+1}: {len(info['addresses'])} адр., "
+                    f"{summary.get('travelTimeInSeconds', 0) // 60} мин, "
+                    f"{summary.get('lengthInMeters', 0) / 1000:.1f} км"
+                )
+            elif info['addresses']:
+                lines.append(f"⚠️ Маршрут {driver_id+1}: не рассчитан")
+            else:
+                lines.append(f"🚛 Маршрут {driver_id+1}: пустой")
+        if lines:
+            try:
+                await message.answer("🔄 Маршруты обновлены:\n" + "\n".join(lines))
+            except Exception:
+                pass
+    
+    # Сессию нельзя вытеснять, пока в ее routes_info пишутся ответы TomTom
+    user_data.pin(user_id)
+    task = run_in_background(update())
+    tasks = route_update_tasks.setdefault(user_id, set())
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+
+async def wait_route_updates(user_id: int):
+    """Дождаться фоновых пересчетов маршрутов пользователя"""
+    tasks = list(route_update_tasks.get(user_id, ()))
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def load_edit_ops(user_id: int, state: FSMContext) -> List[Dict]:
+    """Операции из данных FSM; неприменимые отбрасываются и больше не хранятся"""
+    ops = (await state.get_data()).get('edit_ops', [])
+    _, applied = replay_edit_ops(user_id, ops)
+    if len(applied) != len(ops):
+        await state.update_data(edit_ops=applied)
+    return applied
+
+def estimate_route_km(user_id: int, addresses: List[str], return_to_base: bool = False) -> float:
+    """Локальная оценка длины маршрута (км): по прямой с поправкой на извилистость дорог"""
+    address_coords = user_data[user_id]['address_coords']
+    points = [(addr, address_coords[addr]) for addr in addresses]
+    return route_length_km(user_data[user_id]['production_coords'], points, addresses, return_to_base) * ROAD_CIRCUITY
+
+def describe_edit_ops(user_id: int, ops: List[Dict]) -> str:
+    """Текст со списком правок и прогнозом изменений по маршрутам"""
+    if not ops:
+        return ""
+    
+    lines = ["📝 Изменения (еще не применены):"]
+    for op in ops:
+        short_addr = op['address'].replace("Москва, ", "")[:30]
+        if op['op'] == "move":
+            lines.append(f"➡️ {short_addr}: М{op['source']+1} → М{op['target']+1}")
+        elif op['op'] == "swap":
+            other_addr = op['other'].replace("Москва, ", "")[:30]
+            lines.append(f"🔁 {short_addr} (М{op['source']+1}) ⇄ {other_addr} (М{op['target']+1})")
+        elif op['op'] == "remove":
+            lines.append(f"🗑 {short_addr}: убран из М{op['source']+1}")
     
     routes_info = user_data[user_id]['routes_info']
+    draft = apply_edit_ops(user_id, ops)
+    lines.append("")
+    lines.append("📐 Прогноз (оценка по прямой):")
+    for driver_id, addresses in sorted(draft.items()):
+        info = routes_info[driver_id]
+        if addresses == info['addresses']:
+            continue
+        return_to_base = info.get('return_to_base', False)
+        old_km = estimate_route_km(user_id, info['addresses'], return_to_base)
+        new_km = estimate_route_km(user_id, addresses, return_to_base)
+        lines.append(
+            f"🚛 М{driver_id+1}: {len(info['addresses'])} → {len(addresses)} адр., "
+            f"≈{old_km:.1f} → {new_km:.1f} км"
+        )
+    return "\n".join(lines) + "\n\n"
+
+async def show_edit_menu(message: types.Message, user_id: int, state: FSMContext, edit: bool = True):
+    """Меню выбора маршрута с текущим черновиком правок"""
+    ops = await load_edit_ops(user_id, state)
+    draft = apply_edit_ops(user_id, ops)
+    instant = (await state.get_data()).get('edit_mode', EDIT_MODE) == "instant"
     
     # Создаем клавиатуру для выбора маршрута
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+    rows = [
         [InlineKeyboardButton(
-            text=f"🚛 Маршрут {i+1} ({len(info['addresses'])} адр.)",
+            text=f"🚛 Маршрут {i+1} ({len(addresses)} адр.)",
             callback_data=f"select_source_route_{i}"
-        )] for i, info in sorted(routes_info.items())
-    ] + [
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_main")]
-    ])
+        )] for i, addresses in sorted(draft.items())
+    ]
+    if ops:
+        rows += [
+            [InlineKeyboardButton(text="↩️ Отменить последнее", callback_data="undo_edit")],
+            [InlineKeyboardButton(text="🏁 Завершить редактирование", callback_data="finish_editing")],
+            [InlineKeyboardButton(text="❌ Отменить все изменения", callback_data="back_to_main")]
+        ]
+    elif instant:
+        rows.append([InlineKeyboardButton(text="🏁 Завершить редактирование", callback_data="finish_editing")])
+    else:
+        rows.append([InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_main")])
+    rows.append([InlineKeyboardButton(
+        text="⚡ Применять сразу: вкл" if instant else "⚡ Применять сразу: выкл",
+        callback_data="toggle_edit_mode"
+    )])
     
-    await callback.message.answer(
+    routes_info = user_data[user_id]['routes_info']
+    pending = [str(d + 1) for d, info in sorted(routes_info.items()) if info.get('route_status') == "pending"]
+    text = (
         "📋 *Редактирование маршрутов*\n\n"
-        "Выберите маршрут, из которого хотите переместить адрес:",
-        reply_markup=keyboard
+        + describe_edit_ops(user_id, ops)
+        + (f"⏳ Пересчитываются маршруты: {', '.join(pending)}\n\n" if pending else "")
+        + "Выберите маршрут, из которого хотите переместить адрес:"
     )
+    keyboard = InlineKeyboardMarkup(inline_keyboard=rows)
+    if edit:
+        await message.edit_text(text, reply_markup=keyboard)
+    else:
+        await message.answer(text, reply_markup=keyboard)
     await state.set_state(EditRoutesStates.selecting_route)
+
+async def begin_edit_session(message: types.Message, user_id: int, state: FSMContext):
+    await state.set_data({'edit_ops': [], 'edit_mode': EDIT_MODE})
+    await show_edit_menu(message, user_id, state, edit=False)
+
+@dp.callback_query(F.data == "edit_routes")
+async def start_edit_routes(callback: CallbackQuery, state: FSMContext):
+    user_id = callback.from_user.id
+    
+    if user_id not in user_data or not user_data[user_id].get('routes_info'):
+        await callback.answer("Нет данных о маршрутах")
+        return
+    
+    await begin_edit_session(callback.message, user_id, state)
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("select_source_route_"))
@@ -1023,8 +3718,7 @@ async def select_source_route(callback: CallbackQuery, state: FSMContext):
         await callback.answer("Маршрут не найден")
         return
     
-    info = user_data[user_id]['routes_info'][route_id]
-    addresses = info['addresses']
+    addresses = apply_edit_ops(user_id, await load_edit_ops(user_id, state))[route_id]
     
     if not addresses:
         await callback.answer("В этом маршруте нет адресов для перемещения")
@@ -1056,27 +3750,30 @@ async def select_address(callback: CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
     address_idx = int(callback.data.split("_")[-1])
     
-    # Сохраняем выбранный адрес
-    await state.update_data(address_idx=address_idx)
-    
-    # Получаем данные о маршрутах
-    routes_info = user_data[user_id]['routes_info']
     state_data = await state.get_data()
     source_route_id = state_data.get('source_route_id')
+    draft = apply_edit_ops(user_id, await load_edit_ops(user_id, state))
+    
+    if source_route_id not in draft or address_idx >= len(draft[source_route_id]):
+        await callback.answer("Ошибка: адрес не найден")
+        return
+    
+    # Сохраняем выбранный адрес
+    selected_address = draft[source_route_id][address_idx]
+    await state.update_data(address=selected_address)
     
     # Создаем клавиатуру с целевыми маршрутами (кроме исходного)
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(
-            text=f"🚛 Маршрут {i+1} ({len(info['addresses'])} адр.)",
+            text=f"🚛 Маршрут {i+1} ({len(addresses)} адр.)",
             callback_data=f"select_target_route_{i}"
-        )] for i, info in sorted(routes_info.items()) if i != source_route_id
+        )] for i, addresses in sorted(draft.items()) if i != source_route_id
     ] + [
+        [InlineKeyboardButton(text="🔁 Поменять с адресом другого маршрута", callback_data="swap_address")],
+        [InlineKeyboardButton(text="🗑 Убрать из маршрутов", callback_data="remove_address")],
         [InlineKeyboardButton(text="◀️ Назад к адресам", callback_data=f"select_source_route_{source_route_id}")]
     ])
     
-    # Получаем текст выбранного адреса
-    source_route = routes_info[source_route_id]
-    selected_address = source_route['addresses'][address_idx]
     short_addr = selected_address.replace("Москва, ", "")[:30]
     
     await callback.message.edit_text(
@@ -1087,99 +3784,150 @@ async def select_address(callback: CallbackQuery, state: FSMContext):
     await state.set_state(EditRoutesStates.selecting_target_route)
     await callback.answer()
 
+async def queue_edit_op(callback: CallbackQuery, state: FSMContext, op: Dict, notice: str):
+    """Добавить операцию в черновик и вернуться к выбору маршрута"""
+    user_id = callback.from_user.id
+    ops = await load_edit_ops(user_id, state)
+    if not edit_op_applies(apply_edit_ops(user_id, ops), op):
+        await callback.answer("Это изменение уже учтено")
+        await show_edit_menu(callback.message, user_id, state)
+        return
+    
+    state_data = await state.get_data()
+    if state_data.get('edit_mode', EDIT_MODE) == "instant":
+        # Отвечаем сразу, TomTom пересчитывает затронутые маршруты в фоне
+        await callback.answer("✅ Изменение применено")
+        changed = apply_edit_op_now(user_id, op)
+        if changed:
+            schedule_route_update(callback.message, user_id, changed)
+        await state.update_data(applied_now=state_data.get('applied_now', 0) + 1)
+    else:
+        await state.update_data(edit_ops=ops + [op])
+        await callback.answer(notice)
+    await show_edit_menu(callback.message, user_id, state)
+
 @dp.callback_query(F.data.startswith("select_target_route_"))
 async def select_target_route(callback: CallbackQuery, state: FSMContext):
-    user_id = callback.from_user.id
     target_route_id = int(callback.data.split("_")[-1])
     
     # Получаем сохраненные данные
     state_data = await state.get_data()
     source_route_id = state_data.get('source_route_id')
-    address_idx = state_data.get('address_idx')
+    address = state_data.get('address')
     
-    if None in [source_route_id, address_idx]:
+    if None in [source_route_id, address]:
         await callback.answer("Ошибка данных")
         return
     
-    # Перемещаем адрес
-    source_route = user_data[user_id]['routes_info'][source_route_id]
-    target_route = user_data[user_id]['routes_info'][target_route_id]
+    await queue_edit_op(
+        callback, state,
+        {'op': "move", 'address': address, 'source': source_route_id, 'target': target_route_id},
+        f"➡️ Перемещение в маршрут {target_route_id+1} добавлено"
+    )
+
+@dp.callback_query(F.data == "swap_address")
+async def select_swap_route(callback: CallbackQuery, state: FSMContext):
+    user_id = callback.from_user.id
+    state_data = await state.get_data()
+    source_route_id = state_data.get('source_route_id')
+    draft = apply_edit_ops(user_id, await load_edit_ops(user_id, state))
+    
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text=f"🚛 Маршрут {i+1} ({len(addresses)} адр.)",
+            callback_data=f"swap_route_{i}"
+        )] for i, addresses in sorted(draft.items()) if i != source_route_id and addresses
+    ] + [
+        [InlineKeyboardButton(text="◀️ Назад к адресам", callback_data=f"select_source_route_{source_route_id}")]
+    ])
     
-    if address_idx < len(source_route['addresses']):
-        address = source_route['addresses'].pop(address_idx)
-        target_route['addresses'].append(address)
-        
-        # Оптимизируем порядок в целевом маршруте
-        if target_route['addresses']:
-            points = [(addr, user_data[user_id]['address_coords'][addr]) 
-                     for addr in target_route['addresses'] if addr in user_data[user_id]['address_coords']]
-            production_coords = user_data[user_id]['production_coords']
-            
-            if points and production_coords:
-                optimized_order = optimize_route_nearest_neighbor(production_coords, points)
-                target_route['addresses'] = optimized_order
-        
-        # Пересчитываем маршруты
-        await recalculate_routes(user_id)
-        
-        await callback.answer(f"✅ Адрес перемещен в маршрут {target_route_id+1}")
-        
-        # Возвращаемся к выбору маршрута
-        routes_info = user_data[user_id]['routes_info']
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(
-                text=f"🚛 Маршрут {i+1} ({len(info['addresses'])} адр.)",
-                callback_data=f"select_source_route_{i}"
-            )] for i, info in sorted(routes_info.items())
-        ] + [
-            [InlineKeyboardButton(text="🏁 Завершить редактирование", callback_data="finish_editing")]
-        ])
-        
-        await callback.message.edit_text(
-            "✅ *Адрес успешно перемещен!*\n\n"
-            "Выберите маршрут для дальнейшего редактирования:",
-            reply_markup=keyboard
-        )
-        await state.set_state(EditRoutesStates.selecting_route)
+    await callback.message.edit_text("🔁 Выберите маршрут, с адресом которого поменять:", reply_markup=keyboard)
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith("swap_route_"))
+async def select_swap_target_address(callback: CallbackQuery, state: FSMContext):
+    user_id = callback.from_user.id
+    target_route_id = int(callback.data.split("_")[-1])
+    addresses = apply_edit_ops(user_id, await load_edit_ops(user_id, state))[target_route_id]
+    await state.update_data(swap_route_id=target_route_id)
     
-    else:
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text=f"📍 {addr.replace('Москва, ', '')[:25]}...",
+            callback_data=f"swap_with_{idx}"
+        )] for idx, addr in enumerate(addresses)
+    ] + [
+        [InlineKeyboardButton(text="◀️ Назад", callback_data="swap_address")]
+    ])
+    
+    await callback.message.edit_text(
+        f"🔁 Маршрут {target_route_id+1}: выберите адрес для обмена:",
+        reply_markup=keyboard
+    )
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith("swap_with_"))
+async def swap_addresses(callback: CallbackQuery, state: FSMContext):
+    user_id = callback.from_user.id
+    other_idx = int(callback.data.split("_")[-1])
+    state_data = await state.get_data()
+    source_route_id = state_data.get('source_route_id')
+    target_route_id = state_data.get('swap_route_id')
+    address = state_data.get('address')
+    
+    if None in [source_route_id, target_route_id, address]:
+        await callback.answer("Ошибка данных")
+        return
+    
+    addresses = apply_edit_ops(user_id, await load_edit_ops(user_id, state))[target_route_id]
+    if other_idx >= len(addresses):
         await callback.answer("Ошибка: адрес не найден")
+        return
+    
+    await queue_edit_op(
+        callback, state,
+        {'op': "swap", 'address': address, 'source': source_route_id,
+         'other': addresses[other_idx], 'target': target_route_id},
+        "🔁 Обмен добавлен"
+    )
 
-async def recalculate_routes(user_id: int):
-    """Пересчитать все маршруты после редактирования"""
-    routes_info = user_data[user_id]['routes_info']
-    address_coords = user_data[user_id]['address_coords']
-    production_coords = user_data[user_id]['production_coords']
-    departure_time = user_data[user_id]['departure_time']
+@dp.callback_query(F.data == "remove_address")
+async def remove_address(callback: CallbackQuery, state: FSMContext):
+    state_data = await state.get_data()
+    source_route_id = state_data.get('source_route_id')
+    address = state_data.get('address')
     
-    for driver_id, info in routes_info.items():
-        if info['addresses']:
-            points = [(addr, address_coords[addr]) for addr in info['addresses'] if addr in address_coords]
-            
-            if points and production_coords:
-                # Оптимизируем порядок
-                optimized_order = optimize_route_nearest_neighbor(production_coords, points)
-                info['addresses'] = optimized_order
-                
-                # Формируем waypoints
-                waypoints = [production_coords]
-                for addr in optimized_order:
-                    if addr in address_coords:
-                        waypoints.append(address_coords[addr])
-                
-                # Рассчитываем маршрут
-                route_data = await tomtom_calculate_optimized_route(
-                    waypoints, 
-                    departure_time,
-                    return_to_start=info.get('return_to_base', False)
-                )
-                
-                info['route_data'] = route_data
-                info['waypoints'] = waypoints
+    if None in [source_route_id, address]:
+        await callback.answer("Ошибка данных")
+        return
+    
+    await queue_edit_op(
+        callback, state,
+        {'op': "remove", 'address': address, 'source': source_route_id},
+        "🗑 Удаление добавлено"
+    )
+
+@dp.callback_query(F.data == "undo_edit")
+async def undo_edit(callback: CallbackQuery, state: FSMContext):
+    ops = await load_edit_ops(callback.from_user.id, state)
+    await state.update_data(edit_ops=ops[:-1])
+    await callback.answer("↩️ Последнее изменение отменено")
+    await show_edit_menu(callback.message, callback.from_user.id, state)
+
+@dp.callback_query(F.data == "toggle_edit_mode")
+async def toggle_edit_mode(callback: CallbackQuery, state: FSMContext):
+    if await load_edit_ops(callback.from_user.id, state):
+        await callback.answer("Сначала завершите или отмените накопленные изменения")
+        return
+    instant = (await state.get_data()).get('edit_mode', EDIT_MODE) == "instant"
+    await state.update_data(edit_mode="queue" if instant else "instant")
+    await callback.answer("📝 Изменения копятся до завершения" if instant else "⚡ Изменения применяются сразу")
+    await show_edit_menu(callback.message, callback.from_user.id, state)
 
 @dp.callback_query(F.data == "back_to_route_select")
 async def back_to_route_select(callback: CallbackQuery, state: FSMContext):
-    await start_edit_routes(callback, state)
+    await show_edit_menu(callback.message, callback.from_user.id, state)
+    await callback.answer()
 
 @dp.callback_query(F.data == "back_to_main")
 async def back_to_main(callback: CallbackQuery, state: FSMContext):
@@ -1190,16 +3938,102 @@ async def back_to_main(callback: CallbackQuery, state: FSMContext):
 @dp.callback_query(F.data == "finish_editing")
 async def finish_editing_handler(callback: CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
+    await callback.answer()
+    
+    ops = await load_edit_ops(user_id, state)
+    applied_now = (await state.get_data()).get('applied_now', 0)
+    await state.clear()
+    await wait_route_updates(user_id)
+    
+    session = user_data[user_id]
+    routes_info = session['routes_info']
+    draft = apply_edit_ops(user_id, ops)
+    changed = [d for d, addresses in draft.items() if addresses != routes_info[d]['addresses']]
+    
+    if changed:
+        progress_msg = await callback.message.answer(
+            f"🔄 Применяю изменения ({len(ops)}), пересчитываю маршруты: "
+            + ", ".join(str(d + 1) for d in changed)
+        )
+        # Один проход: порядок измененных маршрутов заново оптимизируется, затем запросы TomTom
+        distance_matrix = get_distance_matrix(user_id)
+        for driver_id in changed:
+            info = routes_info[driver_id]
+            routes_info[driver_id] = plan_route(
+                session['production_coords'], draft[driver_id], session['address_coords'], distance_matrix,
+                return_to_base=info.get('return_to_base', False)
+            )
+            routes_info[driver_id]['original_addresses'] = info['original_addresses']
+        await calculate_routes(routes_info, changed, session['departure_time'])
+        try:
+            await progress_msg.delete()
+        except Exception:
+            pass
     
+    result_text = "Маршруты пересчитаны с учетом изменений." if changed or applied_now else "Изменений нет."
     await callback.message.answer(
-        "✅ *Редактирование завершено!*\n"
-        "Маршруты пересчитаны с учетом изменений.",
+        "✅ *Редактирование завершено!*\n" + result_text,
         reply_markup=get_main_keyboard()
     )
     await show_routes(callback.message, user_id)
-    await state.clear()
+
+# --- Маршрутные инструкции ---
+async def get_route_guidance(user_id: int, driver_id: int) -> Tuple[List[str], Optional[str]]:
+    """Текстовые инструкции TomTom для маршрута: запрашиваются только по требованию"""
+    session = user_data[user_id]
+    info = session['routes_info'][driver_id]
+    data, error = await tomtom_route_request(
+        info['waypoints'], session.get('departure_time'),
+        return_to_start=info.get('return_to_base', False), guidance=True
+    )
+    if error:
+        return [], error
+    instructions = data.get('routes', [{}])[0].get('guidance', {}).get('instructions', [])
+    return [item['message'] for item in instructions if item.get('message')], None
+
+@dp.callback_query(F.data == "guidance_menu")
+async def guidance_menu(callback: CallbackQuery):
+    user_id = callback.from_user.id
+    
+    if user_id not in user_data or not user_data[user_id].get('routes_info'):
+        await callback.answer("Нет данных о маршрутах")
+        return
+    
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text=f"🚛 Маршрут {i+1} ({len(info['addresses'])} адр.)",
+            callback_data=f"guidance_route_{i}"
+        )] for i, info in sorted(user_data[user_id]['routes_info'].items()) if info['addresses']
+    ])
+    await callback.message.answer("🧭 Выберите маршрут:", reply_markup=keyboard)
     await callback.answer()
 
+@dp.callback_query(F.data.startswith("guidance_route_"))
+async def send_route_guidance(callback: CallbackQuery):
+    user_id = callback.from_user.id
+    driver_id = int(callback.data.split("_")[-1])
+    
+    if user_id not in user_data or driver_id not in (user_data[user_id].get('routes_info') or {}):
+        await callback.answer("Маршрут не найден")
+        return
+    
+    await callback.answer("⏳ Запрашиваю инструкции...")
+    instructions, error = await get_route_guidance(user_id, driver_id)
+    if error or not instructions:
+        await callback.message.answer(f"❌ Не удалось получить инструкции: {error or 'пустой ответ'}")
+        return
+    
+    # Telegram ограничивает сообщение 4096 символами
+    text = f"🧭 Маршрут {driver_id+1}\n\n"
+    for i, instruction in enumerate(instructions, 1):
+        line = f"{i}. {instruction}\n"
+        if len(text) + len(line) > 4000:
+            await callback.message.answer(text)
+            text = ""
+        text += line
+    if text:
+        await callback.message.answer(text)
+
 @dp.callback_query(F.data == "show_stats")
 async def show_stats_handler(callback: CallbackQuery):
     user_id = callback.from_user.id
@@ -1239,16 +4073,16 @@ async def export_routes_handler(callback: CallbackQuery):
             short_addr = addr.replace("Москва, ", "")
             export_text += f"{i}. {short_addr}\n"
         
-        route_data = info.get('route_data', {})
-        if route_data:
-            summary = route_data.get('routes', [{}])[0].get('summary', {})
+        summary = route_summary(info, user_data[user_id].get('departure_time'))
+        if summary:
             travel_time = summary.get('travelTimeInSeconds', 0) // 60
             distance = summary.get('lengthInMeters', 0) / 1000
+            note = " (локальная оценка, без данных TomTom)" if summary.get('estimated') else ""
             
             if travel_time > 0:
-                export_text += f"\nОриентировочное время: {travel_time} мин\n"
+                export_text += f"\nОриентировочное время: {travel_time} мин{note}\n"
             if distance > 0:
-                export_text += f"Ориентировочное расстояние: {distance:.1f} км\n"
+                export_text += f"Ориентировочное расстояние: {distance:.1f} км{note}\n"
         
         export_text += "\n" + "=" * 50 + "\n\n"
     
@@ -1266,15 +4100,15 @@ async def export_routes_handler(callback: CallbackQuery):
     await callback.answer()
 
 @dp.message(F.text == "✏️ Редактировать маршруты")
-async def handle_edit_routes(message: types.Message):
+async def handle_edit_routes(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     
-    if user_id not in user_data or 'routes_info' not in user_data[user_id]:
+    if user_id not in user_data or not user_data[user_id].get('routes_info'):
         await message.answer("❌ Сначала распределите адреса по маршрутам",
                            reply_markup=get_main_keyboard())
         return
     
-    await start_edit_routes(types.CallbackQuery(message=message, data="edit_routes"), None)
+    await begin_edit_session(message, user_id, state)
 
 @dp.message(F.text == "📊 Статистика")
 async def handle_stats(message: types.Message):
@@ -1298,8 +4132,159 @@ async def handle_export(message: types.Message):
     
     await export_routes_handler(types.CallbackQuery(message=message, data="export_routes"))
 
+@dp.message(Command("poolstats"))
+async def handle_pool_stats(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    stats = get_http_pool_stats()
+    await message.answer(
+        "🔌 *Пул HTTP-соединений:*\n"
+        f"• Запросов: {stats['requests']}\n"
+        f"• Новых соединений: {stats['connections_created']}\n"
+        f"• Переиспользований: {stats['connections_reused']}\n"
+        f"• Доля переиспользования: {stats['reuse_ratio']:.0%}\n"
+        f"• Свободных keep-alive: {stats['idle_connections']}",
+        parse_mode="Markdown"
+    )
+
+@dp.message(Command("cachestats"))
+async def handle_cache_stats(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    lookups = parse_cache.hits + parse_cache.misses
+    hit_ratio = parse_cache.hits / lookups if lookups else 0.0
+    route_lookups = route_cache.hits + route_cache.misses
+    route_hit_ratio = route_cache.hits / route_lookups if route_lookups else 0.0
+    await message.answer(
+        "🗄 *Кэши:*\n"
+        f"• Геокодирование: {geocode_cache.count()} адресов\n"
+        f"• Разбор накладных: {parse_cache.count()} записей\n"
+        f"• Попаданий: {parse_cache.hits}, промахов: {parse_cache.misses} ({hit_ratio:.0%})\n"
+        f"• Маршруты: {len(route_cache.entries)} записей, {route_cache.size / 1024 / 1024:.1f} МБ\n"
+        f"• Попаданий: {route_cache.hits}, промахов: {route_cache.misses} ({route_hit_ratio:.0%})",
+        parse_mode="Markdown"
+    )
+
+@dp.message(Command("sessions"))
+async def handle_sessions_stats(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    stats = user_data.stats()
+    text = (
+        "👥 *Сессии:*\n"
+        f"• В памяти: {stats['live']} из {SESSION_MAX_LIVE}\n"
+        f"• Всего сохранено: {stats['stored']}\n"
+        f"• Объем в памяти: ~{stats['total_bytes'] / 1024 / 1024:.1f} МБ\n"
+        f"• Вытеснено: {stats['evictions']}\n"
+    )
+    if stats['largest']:
+        text += "\n*Самые большие:*\n"
+        for user_id, size, addresses, idle in stats['largest']:
+            text += f"• {user_id}: ~{size / 1024:.0f} КБ, {addresses} адр., простой {idle / 60:.0f} мин\n"
+    await message.answer(text, parse_mode="Markdown")
+
 async def main():
-    await asyncio.gather(start_web_server(), dp.start_polling(bot))
+    global http_session
+    if bot is None:
+        raise SystemExit("Не задан BOT_TOKEN")
+    http_session = create_http_session()
+    sweeper = asyncio.create_task(sweep_idle_sessions())
+    try:
+        await asyncio.gather(start_web_server(), dp.start_polling(bot))
+    finally:
+        sweeper.cancel()
+        save_sessions()
+        if session_backend is not None:
+            session_backend.close()
+        await close_http_session()
+        nominatim_executor.shutdown(wait=False, cancel_futures=True)
+        pdf_executor.shutdown(wait=False, cancel_futures=True)
+        if _spill_dir and os.path.isdir(_spill_dir):
+            shutil.rmtree(_spill_dir, ignore_errors=True)
+
+def load_text_corpus(path: str) -> List[str]:
+    """Корпус текстов накладных: по одной JSON-строке (или {"text": ...}) в строке файла"""
+    texts = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                texts.append(item['text'] if isinstance(item, dict) else item)
+    return texts
+
+ADDRESS_CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus", "addresses.jsonl")
+
+def verify_address_corpus(path: str) -> List[Tuple[str, Optional[str], Optional[str]]]:
+    """Сверить clean_address с ожидаемыми адресами корпуса ({"text": ..., "address": ...})"""
+    mismatches = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                if isinstance(item, dict) and 'address' in item:
+                    actual = clean_address(item['text'])
+                    if actual != item['address']:
+                        mismatches.append((item['text'], item['address'], actual))
+    return mismatches
+
+def run_cli_command(args: List[str]) -> int:
+    """Служебные команды:
+    python main.py bench-addresses [corpus.jsonl]  (по умолчанию corpus/addresses.jsonl)
+    python main.py bench-routes [точек] [прогонов]
+    python main.py bench-engines [адресов] [водителей] [прогонов]
+    python main.py route-memory calculateRoute.json
+    """
+    if args[0] == "bench-addresses" and len(args) <= 2:
+        path = args[1] if len(args) == 2 else ADDRESS_CORPUS_PATH
+        texts = load_text_corpus(path)
+        regressions = verify_address_corpus(path)
+        for text, expected, actual in regressions[:20]:
+            print(f"REGRESSION: {expected!r} != {actual!r}")
+        mismatches = verify_address_normalizer(texts)
+        for text, expected, actual in mismatches[:20]:
+            print(f"MISMATCH: {expected!r} != {actual!r}")
+        result = benchmark_address_normalizer(texts)
+        print(f"Текстов: {result['texts']}, отличий от ожидаемого: {len(regressions)}, расхождений: {len(mismatches)}")
+        print(f"clean_address: {result['reference_per_sec']:.0f} адресов/с")
+        print(f"AddressNormalizer: {result['compiled_per_sec']:.0f} адресов/с")
+        return 1 if regressions or mismatches else 0
+    
+    if args[0] == "bench-routes":
+        n_stops = int(args[1]) if len(args) > 1 else 200
+        trials = int(args[2]) if len(args) > 2 else 5
+        for return_to_base in (False, True):
+            result = benchmark_route_solver(n_stops, trials, return_to_base)
+            print(f"Точек: {n_stops}, возврат на базу: {'да' if return_to_base else 'нет'}")
+            print(f"  ближайший сосед: {result['nn_km']:.1f} км, {result['nn_sec'] * 1000:.1f} мс")
+            print(f"  solve_route_order: {result['solver_km']:.1f} км, {result['solver_sec'] * 1000:.1f} мс")
+        return 0
+    
+    if args[0] == "bench-engines":
+        n_addresses = int(args[1]) if len(args) > 1 else 300
+        n_drivers = int(args[2]) if len(args) > 2 else 8
+        trials = int(args[3]) if len(args) > 3 else 3
+        result = benchmark_distribution_engines(n_addresses, n_drivers, trials)
+        print(f"Адресов: {n_addresses}, водителей: {n_drivers}")
+        print(f"  balanced_clustering + ближайший сосед: {result['cluster_nn_km']:.1f} км, {result['cluster_nn_sec'] * 1000:.1f} мс")
+        print(f"  balanced_clustering + solve_route_order: {result['cluster_km']:.1f} км, {result['cluster_sec'] * 1000:.1f} мс")
+        print(f"  savings_routes + solve_route_order: {result['savings_km']:.1f} км, {result['savings_sec'] * 1000:.1f} мс")
+        return 0
+    
+    if args[0] == "route-memory" and len(args) == 2:
+        with open(args[1], encoding="utf-8") as f:
+            result = route_memory_report(json.load(f))
+        print(f"Точек линии маршрута: {result['points']}")
+        print(f"  полный ответ TomTom: {result['raw_bytes'] / 1024:.1f} КБ")
+        print(f"  RouteRecord: {result['record_bytes'] / 1024:.1f} КБ")
+        return 0
+    
+    print(run_cli_command.__doc__)
+    return 2
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(run_cli_command(sys.argv[1:]))
     asyncio.run(main())